@@ -1,5 +1,6 @@
 # due to the way KLayout handles Python imports, to import module patching.py
 # we firstly have to add the absolute current working directory to sys.path
+import contextlib
 import os
 import sys
 import pya
@@ -34,6 +35,7 @@ class PatchingDialog(pya.QDialog):
         
         layout.addWidget(pya.QLabel("Electrode Layer:", self), 1, 0)
         self.electrode_layer_input = pya.QLineEdit("1", self)
+        self.electrode_layer_input.setToolTip("several layers separated by commas, e.g. 1, 3, 5")
         layout.addWidget(self.electrode_layer_input, 1, 1)
 
         layout.addWidget(pya.QLabel("Writing Field Layer:", self), 2, 0)
@@ -67,59 +69,352 @@ class PatchingDialog(pya.QDialog):
 
         layout.addWidget(pya.QLabel("Patch Size (µm):", self), 9, 0)
         self.patch_size_input = pya.QLineEdit("8", self)
+        self.patch_size_input.setToolTip("several sizes separated by commas, e.g. 4, 8; with several layers or sizes\n"
+                                         "the patches go to consecutive layers starting at the patch layer,\n"
+                                         "skipping the input and grid layers")
         layout.addWidget(self.patch_size_input, 9, 1)
 
-        # --- OK Buttons ---
+        # Tiled mode: tile size 0 means the whole cell is processed at once
+        layout.addWidget(pya.QLabel("Tile Size (µm, 0 = off):", self), 10, 0)
+        self.tile_size_input = pya.QLineEdit("0", self)
+        layout.addWidget(self.tile_size_input, 10, 1)
+
+        layout.addWidget(pya.QLabel("Tile Origin (µm, x, y):", self), 11, 0)
+        self.tile_origin_input = pya.QLineEdit("", self)
+        self.tile_origin_input.setToolTip("lower-left corner of the writing fields, e.g. -810, -1650;\n"
+                                          "empty: the lower-left corner of the grid")
+        layout.addWidget(self.tile_origin_input, 11, 1)
+
+        layout.addWidget(pya.QLabel("Threads:", self), 12, 0)
+        self.threads_input = pya.QLineEdit(str(os.cpu_count() or 1), self)
+        layout.addWidget(self.threads_input, 12, 1)
+
+        # Hierarchical mode: also take shapes from child cells and arrays
+        self.hierarchical_input = pya.QCheckBox("Include child cells (hierarchical)", self)
+        layout.addWidget(self.hierarchical_input, 13, 0, 1, 2)
+
+        self.merge_patches_input = pya.QCheckBox("Merge overlapping patches", self)
+        layout.addWidget(self.merge_patches_input, 14, 0, 1, 2)
+
+        # Adaptive mode: patches follow the width and direction of every crossing
+        self.adaptive_input = pya.QCheckBox("Adaptive patches (follow the crossing geometry)", self)
+        layout.addWidget(self.adaptive_input, 15, 0, 1, 2)
+
+        # Incremental mode: only re-patch writing fields whose electrodes changed since the last run
+        self.incremental_input = pya.QCheckBox("Incremental (only re-patch changed fields)", self)
+        layout.addWidget(self.incremental_input, 16, 0, 1, 2)
+
+        # Instrumentation: timing summary and trace file for bug reports
+        layout.addWidget(pya.QLabel("Trace File (optional):", self), 17, 0)
+        self.trace_file_input = pya.QLineEdit("", self)
+        self.trace_file_input.setToolTip("*.jsonl: JSON lines, anything else: plain text log")
+        layout.addWidget(self.trace_file_input, 17, 1)
+
+        self.show_summary_input = pya.QCheckBox("Show timing summary", self)
+        layout.addWidget(self.show_summary_input, 18, 0, 1, 2)
+
+        # Chunked mode: patch field by field from the event loop, with progress and cancellation
+        self.chunked_input = pya.QCheckBox("Run in steps (progress, cancellable)", self)
+        layout.addWidget(self.chunked_input, 19, 0, 1, 2)
+
+        # Verification: missing patches, uncovered crossings and narrow patches in the marker browser
+        self.verify_input = pya.QCheckBox("Verify patches (marker browser)", self)
+        layout.addWidget(self.verify_input, 20, 0, 1, 2)
+
+        self.progress_bar = pya.QProgressBar(self)
+        layout.addWidget(self.progress_bar, 21, 0, 1, 2)
+        self.status_label = pya.QLabel("", self)
+        layout.addWidget(self.status_label, 22, 0, 1, 2)
+
+        # --- OK and Cancel Buttons ---
         self.ok_button = pya.QPushButton("Create Patches", self)
         self.ok_button.clicked(self.on_ok_clicked) # Connect button click to a method
-        layout.addWidget(self.ok_button, 10, 0, 1, 2)
+        layout.addWidget(self.ok_button, 23, 0)
+
+        self.cancel_button = pya.QPushButton("Cancel", self)
+        self.cancel_button.clicked(self.on_cancel_clicked)
+        self.cancel_button.setEnabled(False)
+        layout.addWidget(self.cancel_button, 23, 1)
+
+        # the chunked job is advanced by a zero-interval timer, so the UI stays responsive
+        self.job = None
+        self.timer = pya.QTimer(self)
+        self.timer.timeout(self.on_timer)
         
+
     def on_ok_clicked(self):
         """
         This method is executed when the 'Run Patching' button is clicked.
         """
         try:
-            # Get layer input
-            electrode_layer_info = pya.LayerInfo.from_string(self.electrode_layer_input.text + "/0")
-            writing_field_layer_info = pya.LayerInfo.from_string(self.writing_field_layer_input.text + "/0")
-            grid_layer_info = pya.LayerInfo.from_string(self.grid_layer_input.text + "/0")
-            patch_layer_info = pya.LayerInfo.from_string(self.patch_layer_input.text + "/0")
+            from auto_klayout_toolkit import LayoutSession, layer_info, log
+
+            # Get layer input, e.g. "6" (datatype 0) or "6/2"
+            electrode_layer_infos = [layer_info(text) for text in self.electrode_layer_input.text.split(",")]
+            electrode_layer_info = electrode_layer_infos[0]
+            writing_field_layer_info = layer_info(self.writing_field_layer_input.text)
+            grid_layer_info = layer_info(self.grid_layer_input.text)
+            patch_layer_info = layer_info(self.patch_layer_input.text)
             
             # Convert text inputs to numbers (float for sizes, int for layers)
             grid_width = float(self.grid_width_input.text)
-            patch_size = float(self.patch_size_input.text)
-            
-            print("Starting auto-patching process...")
+            patch_sizes = [float(text) for text in self.patch_size_input.text.split(",")]
+            patch_size = patch_sizes[0]
+            tile_size = float(self.tile_size_input.text)
+            tile_origin = tuple(float(text) for text in self.tile_origin_input.text.split(",")) if self.tile_origin_input.text.strip() else None
+            if tile_origin is not None and len(tile_origin) != 2:
+                raise Exception("The tile origin takes two values: x, y.")
+            threads = int(self.threads_input.text)
+            hierarchical = self.hierarchical_input.isChecked()
+            merge_patches = self.merge_patches_input.isChecked()
+            incremental = self.incremental_input.isChecked()
+            chunked = self.chunked_input.isChecked()
+            mode = "adaptive" if self.adaptive_input.isChecked() else "center"
+            trace_file = self.trace_file_input.text.strip()
+            multi = len(electrode_layer_infos) > 1 or len(patch_sizes) > 1
+            if chunked and (incremental or hierarchical or tile_size > 0):
+                raise Exception("Running in steps works with flat, non-tiled, non-incremental patching only.")
+            if incremental and (hierarchical or tile_size > 0):
+                raise Exception("Incremental patching works with flat, non-tiled patching only.")
+            if mode == "adaptive" and (chunked or incremental or tile_size > 0):
+                raise Exception("Adaptive patches can't be combined with tiles, steps or incremental patching.")
+            if multi and (chunked or incremental or tile_size > 0):
+                raise Exception("Several electrode layers or patch sizes can't be combined with tiles, steps or incremental patching.")
 
             # --- call functions to create patches ---
             
-            # Get the main KLayout objects
-            app = pya.Application.instance()
-            mw = app.main_window()
-            lv = mw.current_view()
-            if lv is None: raise Exception("No layout view open.")
-            layout = lv.active_cellview().layout()
-            cell = lv.active_cellview().cell
+            # Get the main KLayout objects; grid, patches and verification share the layers and shapes of the session
+            lv = pya.Application.instance().main_window().current_view()
+            session = LayoutSession.from_view(lv, threads)
+            layout = session.layout
+            cell = session.cell
 
             # Call the grid creation function
-            from patching import create_grid_from_shapes, create_patch
+            from patching import (ChunkedPatchingJob, create_grid_from_shapes, create_patch, create_patch_multi,
+                                  create_patch_tiled, update_patches)
 
-            # Firstly create grid
-            create_grid_from_shapes(layout, cell, 
-                                    writing_field_layer_info.layer, 
-                                    grid_layer_info.layer, 
-                                    grid_width)
-            
-            # Then create patches at the intersection between grid and electrode
-            create_patch(layout, cell,
-                         electrode_layer_info.layer,
-                         grid_layer_info.layer, 
-                         patch_layer_info.layer, 
-                         patch_size)
-            
-            print("Process finished successfully!")
+            if chunked:
+                # nothing is written to the layout before the last step, see on_timer
+                self.job = ChunkedPatchingJob(layout, cell,
+                                              writing_field_layer_info.layer,
+                                              electrode_layer_info.layer,
+                                              grid_layer_info.layer,
+                                              patch_layer_info.layer,
+                                              grid_width,
+                                              patch_size,
+                                              writing_field_layer_info.datatype,
+                                              electrode_layer_info.datatype,
+                                              grid_layer_info.datatype,
+                                              patch_layer_info.datatype,
+                                              merge_patches=merge_patches)
+                self.view = lv
+                self.session = session
+                self.trace_file = trace_file
+                self.verify_args = (electrode_layer_info, grid_layer_info, patch_layer_info, patch_size, False, None)
+                self.progress_bar.setRange(0, self.job.total)
+                self.progress_bar.setValue(0)
+                self.status_label.setText("Creating grid...")
+                self.ok_button.setEnabled(False)
+                self.cancel_button.setEnabled(True)
+                self.timer.start(0)
+                return
+
+            with contextlib.ExitStack() as stack:
+                summary = self.enter_run(stack, lv, layout, trace_file)
+
+                log("Starting auto-patching process...")
+
+                if multi:
+                    # One grid and one boolean per electrode layer for all patch sizes
+                    patch_layers = create_patch_multi(layout, cell,
+                                       writing_field_layer_info.layer,
+                                       [(info.layer, info.datatype) for info in electrode_layer_infos],
+                                       grid_layer_info.layer,
+                                       patch_layer_info.layer,
+                                       grid_width,
+                                       patch_sizes,
+                                       writing_field_layer_info.datatype,
+                                       grid_layer_info.datatype,
+                                       patch_layer_info.datatype,
+                                       hierarchical=hierarchical,
+                                       merge_patches=merge_patches,
+                                       mode=mode,
+                                       session=session)
+                elif incremental:
+                    # Grid and patches are only recomputed where the electrodes changed
+                    update_patches(layout, cell,
+                                   writing_field_layer_info.layer,
+                                   electrode_layer_info.layer,
+                                   grid_layer_info.layer,
+                                   patch_layer_info.layer,
+                                   grid_width,
+                                   patch_size,
+                                   writing_field_layer_info.datatype,
+                                   electrode_layer_info.datatype,
+                                   grid_layer_info.datatype,
+                                   patch_layer_info.datatype,
+                                   merge_patches=merge_patches)
+                else:
+                    # Firstly create grid
+                    create_grid_from_shapes(layout, cell, 
+                                            writing_field_layer_info.layer, 
+                                            grid_layer_info.layer, 
+                                            grid_width,
+                                            writing_field_layer_info.datatype,
+                                            grid_layer_info.datatype,
+                                            hierarchical=hierarchical,
+                                            session=session)
+                    
+                    # Then create patches at the intersection between grid and electrode
+                    if tile_size > 0:
+                        create_patch_tiled(layout, cell,
+                                           electrode_layer_info.layer,
+                                           grid_layer_info.layer,
+                                           patch_layer_info.layer,
+                                           patch_size,
+                                           tile_size,
+                                           threads=threads,
+                                           tile_origin=tile_origin,
+                                           electrode_layer_datatype=electrode_layer_info.datatype,
+                                           grid_layer_datatype=grid_layer_info.datatype,
+                                           patch_layer_datatype=patch_layer_info.datatype,
+                                           merge_patches=merge_patches,
+                                           hierarchical=hierarchical)
+                    else:
+                        create_patch(layout, cell,
+                                     electrode_layer_info.layer,
+                                     grid_layer_info.layer, 
+                                     patch_layer_info.layer, 
+                                     patch_size,
+                                     electrode_layer_info.datatype,
+                                     grid_layer_info.datatype,
+                                     patch_layer_info.datatype,
+                                     hierarchical=hierarchical,
+                                     merge_patches=merge_patches,
+                                     mode=mode,
+                                     session=session)
+                
+                log("Process finished successfully!")
+
+            if incremental or tile_size > 0:
+                # these write grid or patches without the session
+                session.invalidate()
+
+            if self.verify_input.isChecked():
+                # adaptive patches are as narrow as the electrode plus the default margin of 1 um on both sides
+                min_width = 2.0 if mode == "adaptive" else None
+                if multi:
+                    for (electrode_layer, size), output_layer_info in patch_layers.items():
+                        self.show_verification(lv, session, layer_info(electrode_layer), grid_layer_info, output_layer_info,
+                                               size, hierarchical, min_width)
+                else:
+                    self.show_verification(lv, session, electrode_layer_info, grid_layer_info,
+                                           patch_layer_info, patch_size, hierarchical, min_width)
+
+            if self.show_summary_input.isChecked():
+                pya.QMessageBox.information(self, "Auto-Patching", summary.text())
             self.accept() # Close the dialog after success
 
         except Exception as e:
             # Show any errors in a message box
-            pya.QMessageBox.critical(self, "Error", str(e))
\ No newline at end of file
+            pya.QMessageBox.critical(self, "Error", str(e))
+
+    def enter_run(self, stack, view, layout, trace_file):
+        """
+        Group the layout changes of a run into one undo step without redraws in between, and
+        collect its spans. Both end when `stack` is closed; returns the SummarySink.
+        """
+        from auto_klayout_toolkit import JsonLinesSink, LogFileSink, SummarySink, extra_sink
+
+        view.transaction("Auto-Patching")
+        stack.callback(view.commit)
+        layout.start_changes()
+        stack.callback(layout.end_changes)
+
+        # collect the spans of this run, and write them to the trace file if requested
+        summary = stack.enter_context(extra_sink(SummarySink()))
+        if trace_file:
+            sink = JsonLinesSink(trace_file) if trace_file.endswith(".jsonl") else LogFileSink(trace_file)
+            stack.enter_context(extra_sink(sink))
+        return summary
+
+    def show_verification(self, view, session, electrode_layer_info, grid_layer_info, patch_layer_info, patch_size,
+                          hierarchical, min_width):
+        """
+        Verify the patches of the session cell and show the findings in the marker browser of `view`.
+        """
+        from patching import verify_patches
+
+        report = verify_patches(session.layout, session.cell,
+                                electrode_layer_info.layer, grid_layer_info.layer, patch_layer_info.layer, patch_size,
+                                electrode_layer_info.datatype, grid_layer_info.datatype, patch_layer_info.datatype,
+                                hierarchical=hierarchical, min_width=min_width, session=session)
+        if report.num_items() > 0:
+            view.show_rdb(view.add_rdb(report), view.active_cellview().index())
+
+    def on_timer(self):
+        """
+        Process the next chunk of the running job, and insert the result after the last one.
+        """
+        job = self.job
+        try:
+            if job.step():
+                eta = job.eta()
+                self.progress_bar.setValue(job.done)
+                self.status_label.setText(f"Field {job.fields_done}/{job.total - 1}, {job.rate():.0f} shapes/s"
+                                          + (f", {eta:.0f} s left" if eta is not None else ""))
+                return
+
+            self.timer.stop()
+            self.job = None
+            self.progress_bar.setValue(job.total)
+            self.status_label.setText("Inserting shapes...")
+
+            with contextlib.ExitStack() as stack:
+                summary = self.enter_run(stack, self.view, job.layout, self.trace_file)
+                job.commit()
+
+            if self.verify_input.isChecked():
+                # the layout may have been edited between the steps
+                self.session.invalidate()
+                self.show_verification(self.view, self.session, *self.verify_args)
+
+            if self.show_summary_input.isChecked():
+                pya.QMessageBox.information(self, "Auto-Patching", summary.text())
+            self.reset_progress()
+            self.accept() # Close the dialog after success
+
+        except Exception as e:
+            self.timer.stop()
+            self.job = None
+            self.reset_progress()
+            pya.QMessageBox.critical(self, "Error", str(e))
+
+    def on_cancel_clicked(self):
+        """
+        Stop the running job. Its results are only held in memory, so the layout is unchanged.
+        """
+        self.timer.stop()
+        self.job = None
+        self.reset_progress()
+        self.status_label.setText("Cancelled, the layout was not changed.")
+
+    def reject(self):
+        """
+        Esc or the close button of the window: stop a running job first, otherwise its timer
+        keeps firing and writes into the layout after the dialog is closed.
+        """
+        if self.job is not None:
+            self.on_cancel_clicked()
+        super().reject()
+
+    def closeEvent(self, event):
+        if self.job is not None:
+            self.on_cancel_clicked()
+        super().closeEvent(event)
+
+    def reset_progress(self):
+        self.progress_bar.setValue(0)
+        self.status_label.setText("")
+        self.ok_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
\ No newline at end of file
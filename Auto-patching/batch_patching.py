@@ -0,0 +1,321 @@
+# Headless batch auto-patching based on the standalone `klayout` Python module
+# (pip install klayout). Every layout file is patched in its own worker process.
+#
+# usage example:
+#   python batch_patching.py "chips/*.gds" --electrode-layer 6 --writing-field-layer 10 \
+#       --grid-layer 51 --patch-layer 202 --grid-width 1 --patch-size 8 --output-dir patched
+#
+# With --overlay only the electrode and writing field layers are read, and grid and patches
+# go to a separate OASIS file; the input layout itself is never rewritten.
+#
+# Every patched file is verified: crossings without a patch, crossings not fully covered and
+# narrow patches are written to a KLayout report database <output>.lyrdb (off with --no-verify).
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+
+# -----------------------------------------------------------------------------
+import argparse
+import contextlib
+import glob
+import multiprocessing
+import time
+
+import pya
+from patching import PATCH_MODES, create_grid_from_shapes, create_patch, create_patch_tiled, verify_patches
+from patch_cache import PatchCache, cached_grid_and_patch
+from auto_klayout_toolkit import (JsonLinesSink, LayoutSession, extra_sink, layer_info,
+                                  layer_load_options) # importing patching put it on sys.path
+
+
+def expand_inputs(patterns):
+    """
+    Expand glob patterns (Windows shells don't do it for us) and drop duplicates.
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f"Warning: no file matches '{pattern}'.")
+        for file in matches:
+            if file not in files:
+                files.append(file)
+    return files
+
+
+def output_path(input_path, output_dir, suffix, extension=None):
+    """
+    Path of the patched layout: same name and format as the input plus `suffix`,
+    or with `extension` instead of the input's one.
+    """
+    base, ext = os.path.splitext(os.path.basename(input_path))
+    if ext.lower() == ".gz":
+        base, inner_ext = os.path.splitext(base)
+        ext = inner_ext + ext
+    if extension:
+        ext = extension
+    directory = output_dir if output_dir else os.path.dirname(input_path)
+    return os.path.join(directory, base + suffix + ext)
+
+
+def count_shapes(cell, layer_index, hierarchical=False):
+    """
+    Number of shapes on a layer of the cell (not unfolding arrays in hierarchical mode).
+    """
+    if layer_index is None:
+        return 0
+    if not hierarchical:
+        return cell.shapes(layer_index).size()
+    layout = cell.layout()
+    return sum(layout.cell(ci).shapes(layer_index).size() for ci in cell.called_cells() + [cell.cell_index()])
+
+
+def overlay_save_options(layout, cell, layers):
+    """
+    Save options for a compact OASIS file containing only `cell` with its children and
+    the given layers (anything `layer_info` takes), without cells that end up empty.
+    """
+    options = pya.SaveLayoutOptions()
+    options.format = "OASIS"
+    # other top cells would stay in the file without shapes, so it has no single top cell
+    options.select_cell(cell.cell_index())
+    options.deselect_all_layers()
+    for layer in layers:
+        layer_index = layout.find_layer(layer_info(layer))
+        if layer_index is not None:
+            options.add_layer(layer_index, layer_info(layer))
+    options.no_empty_cells = True
+    options.oasis_compression_level = 10
+    options.oasis_write_cblocks = True
+    return options
+
+
+def patch_file(job):
+    """
+    Load one layout, create grid and patches on its top cell and write the result.
+    Runs inside a worker process; returns a dictionary with timing and counts.
+    """
+    result = {"input": job["input"], "output": job["output"], "ok": False}
+    try:
+        with contextlib.ExitStack() as stack:
+            if job["quiet"]:
+                stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+            if job["trace"]:
+                trace_path = job["output"] + ".trace.jsonl"
+                if os.path.exists(trace_path):
+                    os.remove(trace_path)
+                stack.enter_context(extra_sink(JsonLinesSink(trace_path)))
+
+            t_start = time.perf_counter()
+            layout = pya.Layout()
+            if job["overlay"]:
+                # the pipeline only needs the electrodes and the writing fields
+                layout.read(job["input"], layer_load_options([job["electrode_layer"], job["writing_field_layer"]]))
+            else:
+                layout.read(job["input"])
+            if job["top_cell"]:
+                cell = layout.cell(job["top_cell"])
+                if cell is None:
+                    raise Exception(f"Cell '{job['top_cell']}' not found.")
+            else:
+                cell = layout.top_cell() # raises if there is more than one top cell
+            t_load = time.perf_counter()
+
+            # the layers come as strings, pya.LayerInfo can't be pickled
+            electrode_info, field_info, grid_info, patch_info = [
+                layer_info(job[key]) for key in ("electrode_layer", "writing_field_layer", "grid_layer", "patch_layer")]
+            electrode_layer, electrode_datatype = electrode_info.layer, electrode_info.datatype
+            field_layer, field_datatype = field_info.layer, field_info.datatype
+            grid_layer, grid_datatype = grid_info.layer, grid_info.datatype
+            patch_layer, patch_datatype = patch_info.layer, patch_info.datatype
+
+            electrode_index = layout.find_layer(electrode_info)
+            patch_index = layout.find_layer(patch_info)
+            electrode_count = count_shapes(cell, electrode_index, job["hierarchical"])
+            patches_before = count_shapes(cell, patch_index, job["hierarchical"])
+
+            # grid, patches and verification share the merged layers; not used by the cached and tiled modes
+            session = None
+            if job["cache"] and not job["hierarchical"]:
+                cache = PatchCache(job["cache"], job["cache_size"])
+                cached_grid_and_patch(cache, layout, cell, field_layer, electrode_layer, grid_layer, patch_layer,
+                                      job["grid_width"], job["patch_size"], field_datatype, electrode_datatype,
+                                      grid_datatype, patch_datatype, merge_patches=job["merge_patches"],
+                                      tile_size=job["tile_size"], threads=job["threads"],
+                                      mode=job["patch_mode"], patch_margin=job["patch_margin"],
+                                      tile_origin=job["tile_origin"])
+                result.update(cache_hits=cache.hits, cache_misses=cache.misses, cache_evictions=cache.evictions)
+            elif job["tile_size"]:
+                create_grid_from_shapes(layout, cell, field_layer, grid_layer, job["grid_width"],
+                                        field_datatype, grid_datatype, hierarchical=job["hierarchical"])
+                create_patch_tiled(layout, cell, electrode_layer, grid_layer, patch_layer, job["patch_size"],
+                                   job["tile_size"], threads=job["threads"], tile_origin=job["tile_origin"],
+                                   electrode_layer_datatype=electrode_datatype,
+                                   grid_layer_datatype=grid_datatype,
+                                   patch_layer_datatype=patch_datatype,
+                                   merge_patches=job["merge_patches"], hierarchical=job["hierarchical"])
+            else:
+                session = LayoutSession(layout, cell, job["threads"])
+                create_grid_from_shapes(layout, cell, field_layer, grid_layer, job["grid_width"],
+                                        field_datatype, grid_datatype, hierarchical=job["hierarchical"],
+                                        session=session)
+                create_patch(layout, cell, electrode_layer, grid_layer, patch_layer, job["patch_size"],
+                             electrode_datatype, grid_datatype, patch_datatype,
+                             hierarchical=job["hierarchical"], merge_patches=job["merge_patches"],
+                             mode=job["patch_mode"], patch_margin=job["patch_margin"], session=session)
+            t_patch = time.perf_counter()
+
+            if job["verify"]:
+                # adaptive patches are as narrow as the electrode plus the margin on both sides
+                min_width = 2 * job["patch_margin"] if job["patch_mode"] == "adaptive" else None
+                report = verify_patches(layout, cell, electrode_layer, grid_layer, patch_layer, job["patch_size"],
+                                        electrode_datatype, grid_datatype, patch_datatype,
+                                        hierarchical=job["hierarchical"], threads=job["threads"], min_width=min_width,
+                                        session=session)
+                report.save(job["output"] + ".lyrdb")
+                result["violations"] = {category.name(): category.num_items() for category in report.each_category()}
+            t_verify = time.perf_counter()
+
+            patch_index = layout.find_layer(patch_info)
+            if job["overlay"]:
+                layout.write(job["output"], overlay_save_options(layout, cell, [job["grid_layer"], job["patch_layer"]]))
+            else:
+                layout.write(job["output"])
+            t_write = time.perf_counter()
+
+        result.update(ok=True,
+                      electrodes=electrode_count,
+                      patches=count_shapes(cell, patch_index, job["hierarchical"]) - patches_before,
+                      load_time=t_load - t_start,
+                      patch_time=t_patch - t_load,
+                      verify_time=t_verify - t_patch,
+                      write_time=t_write - t_verify)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def print_summary(results, wall_time):
+    """
+    Print a per-file timing and throughput table, and the verification results.
+    """
+    print(f"\n{'file':<40} {'electrodes':>10} {'patches':>8} {'load s':>8} {'patch s':>8} {'verify s':>8} {'write s':>8} {'shapes/s':>10}")
+    busy_time = 0.0
+    failed = 0
+    for result in results:
+        name = os.path.basename(result["input"])
+        if not result["ok"]:
+            failed += 1
+            print(f"{name:<40} FAILED: {result['error']}")
+            continue
+        total = result["load_time"] + result["patch_time"] + result["verify_time"] + result["write_time"]
+        busy_time += total
+        rate = result["electrodes"] / result["patch_time"] if result["patch_time"] > 0 else 0.0
+        print(f"{name:<40} {result['electrodes']:>10} {result['patches']:>8} {result['load_time']:>8.2f} "
+              f"{result['patch_time']:>8.2f} {result['verify_time']:>8.2f} {result['write_time']:>8.2f} {rate:>10.0f}")
+    print(f"\n{len(results) - failed} file(s) patched, {failed} failed, wall time {wall_time:.2f} s "
+          f"(sum of per-file times {busy_time:.2f} s, speed-up x{busy_time / wall_time if wall_time > 0 else 0:.1f}).")
+    cached = [result for result in results if "cache_hits" in result]
+    if cached:
+        hits = sum(result["cache_hits"] for result in cached)
+        misses = sum(result["cache_misses"] for result in cached)
+        evictions = sum(result["cache_evictions"] for result in cached)
+        print(f"Cache: {hits} hit(s), {misses} miss(es), {evictions} eviction(s).")
+    verified = [result for result in results if "violations" in result]
+    if verified:
+        print(f"\n{'verification':<40} {'missing':>10} {'uncovered':>10} {'narrow':>10}")
+        for result in verified:
+            violations = result["violations"]
+            print(f"{os.path.basename(result['input']):<40} {violations['missing patch']:>10} "
+                  f"{violations['uncovered crossing']:>10} {violations['narrow patch']:>10}")
+        failing = sum(1 for result in verified if any(result["violations"].values()))
+        print(f"{failing} of {len(verified)} file(s) with findings, see <output>.lyrdb.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Auto-patch many GDS/OASIS files in parallel.")
+    parser.add_argument("inputs", nargs="+", help="layout files or glob patterns")
+    parser.add_argument("--electrode-layer", required=True, help="electrode layer, e.g. 6 or 6/0")
+    parser.add_argument("--writing-field-layer", required=True, help="writing field layer")
+    parser.add_argument("--grid-layer", required=True, help="output layer of the grid")
+    parser.add_argument("--patch-layer", required=True, help="output layer of the patches")
+    parser.add_argument("--grid-width", type=float, default=1.0, help="grid line width in um (default: 1)")
+    parser.add_argument("--patch-size", type=float, default=8.0, help="patch size in um (default: 8)")
+    parser.add_argument("--patch-mode", choices=PATCH_MODES, default="center", help="center: square patches at the crossing centers; adaptive: patches following the crossing geometry (default: center)")
+    parser.add_argument("--patch-margin", type=float, default=1.0, help="margin of adaptive patches beyond the electrode edges in um (default: 1)")
+    parser.add_argument("--merge-patches", action="store_true", help="merge overlapping patches into one shape")
+    parser.add_argument("--hierarchical", action="store_true", help="include shapes of child cells, the patches go to the patched cell")
+    parser.add_argument("--tile-size", type=float, default=0.0, help="patch in tiles of this size in um, e.g. the writing field size (default: off)")
+    parser.add_argument("--tile-origin", type=float, nargs=2, default=None, metavar=("X", "Y"), help="lower-left corner of the writing fields in um, the tiles are aligned to it (default: lower-left corner of the grid)")
+    parser.add_argument("--threads", type=int, default=1, help="threads per file in tiled mode and verification (default: 1)")
+    parser.add_argument("--top-cell", default=None, help="cell to patch (default: the single top cell)")
+    parser.add_argument("--output-dir", default=None, help="directory of the patched files (default: next to the input)")
+    parser.add_argument("--suffix", default="_patched", help="suffix of the patched file names (default: _patched)")
+    parser.add_argument("--overlay", action="store_true", help="load only the electrode and writing field layers and write grid and patches to an OASIS overlay <name><suffix>.oas")
+    parser.add_argument("--cache", default=None, help="directory of the result cache, unchanged inputs are not patched again (top-cell shapes, ignored with --hierarchical)")
+    parser.add_argument("--cache-size", type=float, default=1024.0, help="size limit of the cache in MB (default: 1024)")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="skip the verification and the report database <output>.lyrdb")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--trace", action="store_true", help="write a JSON lines trace <output>.trace.jsonl per file")
+    parser.add_argument("--quiet", action="store_true", help="suppress the per-step output of the workers")
+    args = parser.parse_args(argv)
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        parser.error("no input files")
+    if args.patch_mode == "adaptive" and args.tile_size:
+        parser.error("--patch-mode adaptive can't be combined with --tile-size")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = []
+    for file in files:
+        out = output_path(file, args.output_dir, args.suffix, ".oas" if args.overlay else None)
+        if os.path.abspath(out) == os.path.abspath(file):
+            parser.error(f"output would overwrite the input file {file}")
+        jobs.append({"input": file,
+                     "output": out,
+                     "top_cell": args.top_cell,
+                     "electrode_layer": args.electrode_layer,
+                     "writing_field_layer": args.writing_field_layer,
+                     "grid_layer": args.grid_layer,
+                     "patch_layer": args.patch_layer,
+                     "grid_width": args.grid_width,
+                     "patch_size": args.patch_size,
+                     "patch_mode": args.patch_mode,
+                     "patch_margin": args.patch_margin,
+                     "hierarchical": args.hierarchical,
+                     "merge_patches": args.merge_patches,
+                     "tile_size": args.tile_size,
+                     "tile_origin": tuple(args.tile_origin) if args.tile_origin else None,
+                     "threads": args.threads,
+                     "overlay": args.overlay,
+                     "cache": args.cache,
+                     "cache_size": int(args.cache_size * 1024**2),
+                     "verify": args.verify,
+                     "trace": args.trace,
+                     "quiet": args.quiet})
+
+    processes = min(args.processes or os.cpu_count() or 1, len(jobs))
+    print(f"Patching {len(jobs)} file(s) with {processes} worker process(es)...")
+
+    t_start = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap_unordered(patch_file, jobs):
+            status = "done" if result["ok"] else "FAILED"
+            print(f"[{len(results) + 1}/{len(jobs)}] {status}: {result['input']}")
+            results.append(result)
+    wall_time = time.perf_counter() - t_start
+
+    results.sort(key=lambda r: files.index(r["input"]))
+    print_summary(results, wall_time)
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# Benchmark of the patching pipeline on synthetic chips, based on the standalone
+# `klayout` Python module (pip install klayout). Results are written as JSON, so runs
+# of different versions can be compared.
+#
+# usage example:
+#   python benchmark.py --fields 10 --electrodes 1000 10000 100000 --shapes manhattan diagonal pad \
+#       --depth 2 --repeat 3 --output bench.json
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+
+# -----------------------------------------------------------------------------
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import platform
+import random
+import time
+
+import pya
+from patching import create_grid_from_shapes, create_patch, create_patch_tiled, create_patch_from_lattice
+from auto_klayout_toolkit import SummarySink, extra_sink # importing patching put it on sys.path
+
+try:
+    import resource # not available on Windows
+except ImportError:
+    resource = None
+
+# layers of the synthetic chips
+ELECTRODE_LAYER = 6
+WRITING_FIELD_LAYER = 10
+GRID_LAYER = 51
+PATCH_LAYER = 202
+
+SHAPE_TYPES = ("manhattan", "diagonal", "pad")
+PIPELINES = ("boolean", "hierarchical", "tiled", "lattice")
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, or None if unknown. It never goes down,
+    so every run has a process of its own, see `run_job`.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def random_electrode(rng, shape_type, extent_dbu, field_size_dbu):
+    """
+    One random electrode inside the box (0, 0)-(extent_dbu, extent_dbu):
+    a straight lead, a lead with a 45 degree bend, or a round pad.
+    """
+    x = rng.randint(0, extent_dbu)
+    y = rng.randint(0, extent_dbu)
+    width = rng.randint(2000, 20000)
+    length = int(field_size_dbu * rng.uniform(0.1, 1.2))
+    if shape_type == "manhattan":
+        if rng.random() < 0.5:
+            return pya.Polygon(pya.Box(x, y, x + length, y + width))
+        return pya.Polygon(pya.Box(x, y, x + width, y + length))
+    if shape_type == "diagonal":
+        d = length // 3
+        points = [pya.Point(x, y), pya.Point(x + d, y), pya.Point(x + 2 * d, y + d), pya.Point(x + 2 * d, y + 2 * d)]
+        return pya.Path(points, width).polygon()
+    radius = rng.randint(10000, 100000)
+    return pya.Polygon.ellipse(pya.Box(x - radius, y - radius, x + radius, y + radius), 64)
+
+
+def generate_chip(fields=10, field_size=1000.0, electrodes=1000, shape_types=SHAPE_TYPES,
+                  hierarchy_depth=0, seed=0, dbu=0.001):
+    """
+    Create a synthetic chip: `fields` x `fields` writing fields of `field_size` (um) on
+    WRITING_FIELD_LAYER and about `electrodes` random electrodes on ELECTRODE_LAYER.
+    With `hierarchy_depth` > 0 the electrodes sit in a device cell which is placed through
+    `hierarchy_depth` levels of 2x2 arrays, the top cell arrays the highest level.
+    Returns (layout, top cell).
+    """
+    rng = random.Random(seed)
+    layout = pya.Layout()
+    layout.dbu = dbu
+    top = layout.create_cell("TOP")
+    electrode_layer_index = layout.layer(ELECTRODE_LAYER, 0)
+    field_layer_index = layout.layer(WRITING_FIELD_LAYER, 0)
+
+    field_size_dbu = int(field_size / dbu)
+    extent_dbu = fields * field_size_dbu
+    for i in range(fields):
+        for j in range(fields):
+            top.shapes(field_layer_index).insert(pya.Box(i * field_size_dbu, j * field_size_dbu,
+                                                         (i + 1) * field_size_dbu, (j + 1) * field_size_dbu))
+
+    if hierarchy_depth <= 0:
+        polygons = [random_electrode(rng, rng.choice(shape_types), extent_dbu, field_size_dbu) for _ in range(electrodes)]
+        top.shapes(electrode_layer_index).insert(pya.Region(polygons))
+        return layout, top
+
+    # each level doubles the pitch, the top cell arrays the highest level over the whole chip
+    top_count = 2
+    level_pitch = extent_dbu // (top_count * 2**hierarchy_depth)
+    instances = top_count**2 * 4**hierarchy_depth
+    device = layout.create_cell("DEVICE")
+    device_electrodes = max(1, electrodes // instances)
+    polygons = [random_electrode(rng, rng.choice(shape_types), level_pitch, field_size_dbu) for _ in range(device_electrodes)]
+    device.shapes(electrode_layer_index).insert(pya.Region(polygons))
+
+    child = device
+    for level in range(1, hierarchy_depth + 1):
+        cell = layout.create_cell(f"LEVEL{level}")
+        cell.insert(pya.CellInstArray(child.cell_index(), pya.Trans(),
+                                      pya.Vector(level_pitch, 0), pya.Vector(0, level_pitch), 2, 2))
+        child = cell
+        level_pitch *= 2
+    top.insert(pya.CellInstArray(child.cell_index(), pya.Trans(),
+                                 pya.Vector(level_pitch, 0), pya.Vector(0, level_pitch), top_count, top_count))
+    return layout, top
+
+
+def shape_count(cell, layer, hierarchical=True):
+    """
+    Number of shapes on (layer, 0) below `cell`, flattened if `hierarchical` is True.
+    """
+    layer_index = cell.layout().find_layer(layer, 0)
+    if layer_index is None:
+        return 0
+    if not hierarchical:
+        return cell.shapes(layer_index).size()
+    iterator = cell.begin_shapes_rec(layer_index)
+    count = 0
+    while not iterator.at_end():
+        count += 1
+        iterator.next()
+    return count
+
+
+def run_pipeline(pipeline, layout, cell, fields, field_size, grid_width, patch_size, threads):
+    """
+    Run one pipeline variant on `layout`, returning a list of stage results with the wall time, 
+    the peak RSS after the stage, the output shape count and the instrumentation spans.
+    """
+    stages = []
+    def stage(name, function, output_layer, *args, **kwargs):
+        t_start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), extra_sink(SummarySink()) as summary:
+            function(*args, **kwargs)
+        seconds = time.perf_counter() - t_start
+        stages.append({"stage": name,
+                       "seconds": seconds,
+                       "peak_rss_mb": peak_rss_mb(),
+                       "output_shapes": shape_count(cell, output_layer),
+                       "spans": [span.to_dict() for span in summary.spans]})
+
+    hierarchical = pipeline == "hierarchical"
+    if pipeline == "lattice":
+        # the lattice covers the writing fields, their outer boundary is not a stitch line
+        stage("patch", create_patch_from_lattice, PATCH_LAYER,
+              layout, cell, ELECTRODE_LAYER, PATCH_LAYER, patch_size,
+              fields * field_size, field_size, grid_width, 0.0, 0.0)
+        return stages
+
+    stage("grid", create_grid_from_shapes, GRID_LAYER,
+          layout, cell, WRITING_FIELD_LAYER, GRID_LAYER, grid_width, hierarchical=hierarchical)
+    if pipeline == "tiled":
+        stage("patch", create_patch_tiled, PATCH_LAYER,
+              layout, cell, ELECTRODE_LAYER, GRID_LAYER, PATCH_LAYER, patch_size, field_size, threads=threads,
+              hierarchical=True)
+    else:
+        stage("patch", create_patch, PATCH_LAYER,
+              layout, cell, ELECTRODE_LAYER, GRID_LAYER, PATCH_LAYER, patch_size, hierarchical=hierarchical)
+    return stages
+
+
+def run_job(job):
+    """
+    Load the chip of `job` and run one pipeline on it. Runs in a fresh worker process, so
+    the peak memory is that of this pipeline only; `base_rss_mb` is the peak after loading.
+    """
+    layout = pya.Layout()
+    layout.read_bytes(job["chip"])
+    cell = layout.cell(job["top_cell"])
+    base_rss_mb = peak_rss_mb()
+    stages = run_pipeline(job["pipeline"], layout, cell, job["fields"], job["field_size"],
+                          job["grid_width"], job["patch_size"], job["threads"])
+    return base_rss_mb, stages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the auto-patching pipeline on synthetic chips.")
+    parser.add_argument("--fields", type=int, default=10, help="writing fields per side (default: 10)")
+    parser.add_argument("--field-size", type=float, default=1000.0, help="writing field size in um (default: 1000)")
+    parser.add_argument("--electrodes", type=int, nargs="+", default=[1000], help="electrode count(s) to benchmark")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPE_TYPES, default=list(SHAPE_TYPES), help="electrode shapes")
+    parser.add_argument("--depth", type=int, default=0, help="hierarchy depth of the electrodes (default: 0, flat); the boolean and lattice pipelines only see top-cell shapes")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=list(PIPELINES), help="pipelines to run")
+    parser.add_argument("--grid-width", type=float, default=1.0, help="grid line width in um (default: 1)")
+    parser.add_argument("--patch-size", type=float, default=8.0, help="patch size in um (default: 8)")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="threads of the tiled pipeline")
+    parser.add_argument("--repeat", type=int, default=1, help="repetitions of each run (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the chip generator")
+    parser.add_argument("--output", default="bench.json", help="JSON result file (default: bench.json)")
+    args = parser.parse_args(argv)
+
+    try:
+        import klayout
+        klayout_version = klayout.__version__
+    except ImportError:
+        klayout_version = pya.Application.instance().version()
+
+    runs = []
+    for electrodes in args.electrodes:
+        t_start = time.perf_counter()
+        layout, top = generate_chip(args.fields, args.field_size, electrodes, args.shapes, args.depth, args.seed)
+        generate_time = time.perf_counter() - t_start
+        input_electrodes = shape_count(top, ELECTRODE_LAYER)
+        print(f"Chip with {input_electrodes} electrodes in {args.fields}x{args.fields} fields generated in {generate_time:.2f} s")
+        options = pya.SaveLayoutOptions()
+        options.format = "OASIS"
+        chip = layout.write_bytes(options)
+
+        for pipeline in args.pipelines:
+            for repetition in range(args.repeat):
+                # one process per run, so every run starts from the same chip and its memory peak is its own
+                job = {"chip": chip,
+                       "top_cell": top.name,
+                       "pipeline": pipeline,
+                       "fields": args.fields,
+                       "field_size": args.field_size,
+                       "grid_width": args.grid_width,
+                       "patch_size": args.patch_size,
+                       "threads": args.threads}
+                with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                    base_rss_mb, stages = pool.apply(run_job, (job,))
+                total = sum(s["seconds"] for s in stages)
+                runs.append({"electrodes": electrodes,
+                             "input_electrodes": input_electrodes,
+                             "pipeline": pipeline,
+                             "repetition": repetition,
+                             "total_seconds": total,
+                             "base_rss_mb": base_rss_mb,
+                             "stages": stages})
+                timings = ", ".join(f"{s['stage']} {s['seconds']:.3f} s" for s in stages)
+                print(f"  {pipeline:<12} #{repetition}: {timings} -> {stages[-1]['output_shapes']} patches")
+
+    result = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "klayout": klayout_version,
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "parameters": {"fields": args.fields,
+                             "field_size": args.field_size,
+                             "shapes": args.shapes,
+                             "depth": args.depth,
+                             "grid_width": args.grid_width,
+                             "patch_size": args.patch_size,
+                             "threads": args.threads,
+                             "seed": args.seed},
+              "runs": runs}
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# Cut the layout into its writing fields: the shapes of the selected layers (e.g. electrodes
+# and patches) are clipped to every field of the lattice used by `create_grid` and exported
+# with a field-local origin, either as one file per field or as one cell per field in a
+# single layout. The fields are clipped in parallel worker processes; a JSON manifest lists
+# the position and polygon count of every field.
+#
+# usage example:
+#   python field_export.py chip.gds --layers 6 202 --area-size 5000 --field-size 100 \
+#       --x-left 0 --y-bottom 0 --output fields --manifest fields/manifest.json
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+
+# -----------------------------------------------------------------------------
+import argparse
+import json
+import multiprocessing
+import time
+
+import pya
+from patching import lattice_axes, lattice_fields
+from auto_klayout_toolkit import layer_info, layer_load_options # importing patching put it on sys.path
+
+ORIGINS = ("lower-left", "center")
+
+# layout of the worker process, loaded once by `init_worker`
+worker_layout = None
+worker_cell = None
+
+
+def field_boxes(area_size, field_size, x_left, y_bottom, dbu):
+    """
+    The writing fields of the lattice drawn by `create_grid`, as (column, row, pya.Box) in dbu,
+    row by row from the lower-left field.
+    """
+    x_axis, y_axis = lattice_axes(dbu, area_size, field_size, x_left, y_bottom)
+    columns = x_axis[2]
+    return [(k % columns, k // columns, box) for k, box in enumerate(lattice_fields(x_axis, y_axis))]
+
+
+def field_name(column, row):
+    return f"FIELD_{column}_{row}"
+
+
+def field_origin(box, origin):
+    """
+    Point of the field `box` which becomes (0, 0) of the exported field.
+    """
+    if origin == "center":
+        return box.center()
+    return box.p1
+
+
+def clip_field(cell, layer_indexes, box):
+    """
+    Shapes of `cell` and its children on each layer clipped to `box`, as a list of Regions
+    (empty for a layer index None).
+    """
+    clip = pya.Region(box)
+    return [pya.Region(cell.begin_shapes_rec_touching(layer_index, box)) & clip if layer_index is not None else pya.Region()
+            for layer_index in layer_indexes]
+
+
+def init_worker(input_path, layers, top_cell):
+    """
+    Load the layers to export once per worker process.
+    """
+    global worker_layout, worker_cell
+    worker_layout = pya.Layout()
+    worker_layout.read(input_path, layer_load_options(layers))
+    worker_cell = worker_layout.cell(top_cell) if top_cell else worker_layout.top_cell()
+    if worker_cell is None:
+        raise Exception(f"Cell '{top_cell}' not found.")
+
+
+def export_row(task):
+    """
+    Clip the fields of one task and export them. In "files" mode every non-empty field is
+    written to its own file, in "cells" mode it is returned as an OASIS blob.
+    Returns a list of (manifest entry, blob or None).
+    """
+    layout = worker_layout
+    layer_infos = [layer_info(layer) for layer in task["layers"]]
+    layer_indexes = [layout.find_layer(info) for info in layer_infos]
+
+    results = []
+    for column, row, (left, bottom, right, top) in task["fields"]:
+        box = pya.Box(left, bottom, right, top)
+        origin = field_origin(box, task["origin"])
+        name = field_name(column, row)
+        entry = {"column": column,
+                 "row": row,
+                 "name": name,
+                 "box": [left * layout.dbu, bottom * layout.dbu, right * layout.dbu, top * layout.dbu],
+                 "origin": [origin.x * layout.dbu, origin.y * layout.dbu],
+                 "polygons": {},
+                 "file": None}
+
+        field_layout = pya.Layout()
+        field_layout.dbu = layout.dbu
+        field_cell = field_layout.create_cell(name)
+        for info, region in zip(layer_infos, clip_field(worker_cell, layer_indexes, box)):
+            entry["polygons"][str(info)] = region.count()
+            if not region.is_empty():
+                field_cell.shapes(field_layout.layer(info)).insert(region.moved(-origin.x, -origin.y))
+        entry["total_polygons"] = sum(entry["polygons"].values())
+
+        blob = None
+        if entry["total_polygons"] > 0:
+            if task["mode"] == "files":
+                entry["file"] = name + task["extension"]
+                field_layout.write(os.path.join(task["output"], entry["file"]))
+            else:
+                options = pya.SaveLayoutOptions()
+                options.format = "OASIS"
+                blob = field_layout.write_bytes(options)
+        results.append((entry, blob))
+    return results
+
+
+def export_fields(input_path, layers, area_size, field_size, x_left, y_bottom, output,
+                  mode="files", origin="lower-left", extension=".oas", top_cell=None, processes=None):
+    """
+    Clip the shapes of `layers` (layer strings like "6/0" or (layer, datatype) tuples) of the layout file `input_path` to
+    every writing field of the lattice and export them with a field-local `origin`
+    ("lower-left" or "center" of the field).
+    `mode` "files": one file <name><extension> per field in the directory `output`;
+    `mode` "cells": one cell per field in the layout file `output`, plus a top cell "FIELDS"
+    placing them at their positions. Empty fields are not exported.
+    Returns the manifest as a dictionary.
+    """
+    if mode not in ("files", "cells"):
+        raise ValueError(f"Unknown mode '{mode}'.")
+    if origin not in ORIGINS:
+        raise ValueError(f"Unknown origin '{origin}'.")
+    if mode == "files":
+        os.makedirs(output, exist_ok=True)
+
+    # the main process needs the layout for the dbu, and works as the only worker without a pool
+    init_worker(input_path, layers, top_cell)
+    dbu = worker_layout.dbu
+    fields = field_boxes(area_size, field_size, x_left, y_bottom, dbu)
+
+    # one task per row of fields
+    rows = {}
+    for column, row, box in fields:
+        rows.setdefault(row, []).append((column, row, (box.left, box.bottom, box.right, box.top)))
+    tasks = [{"fields": row_fields, "layers": layers, "origin": origin, "mode": mode,
+              "output": output, "extension": extension} for _, row_fields in sorted(rows.items())]
+
+    processes = min(processes or os.cpu_count() or 1, max(len(tasks), 1))
+    t_start = time.perf_counter()
+    if processes > 1:
+        with multiprocessing.Pool(processes, init_worker, (input_path, layers, top_cell)) as pool:
+            results = [result for row_results in pool.map(export_row, tasks) for result in row_results]
+    else:
+        results = [result for task in tasks for result in export_row(task)]
+    clip_time = time.perf_counter() - t_start
+
+    if mode == "cells":
+        layout = pya.Layout()
+        layout.dbu = dbu
+        for entry, blob in results:
+            if blob is not None:
+                layout.read_bytes(blob)
+        top = layout.create_cell("FIELDS")
+        for entry, blob in results:
+            if blob is not None:
+                x, y = entry["origin"]
+                top.insert(pya.CellInstArray(layout.cell(entry["name"]).cell_index(),
+                                             pya.Trans(pya.Vector(round(x / dbu), round(y / dbu)))))
+        layout.write(output)
+
+    return {"input": input_path,
+            "mode": mode,
+            "output": output,
+            "dbu": dbu,
+            "area_size": area_size,
+            "field_size": field_size,
+            "x_left": x_left,
+            "y_bottom": y_bottom,
+            "origin": origin,
+            "layers": [str(layer_info(layer)) for layer in layers],
+            "clip_time": clip_time,
+            "processes": processes,
+            "fields": [entry for entry, _ in results]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clip a layout to its writing fields and export every field.")
+    parser.add_argument("input", help="layout file")
+    parser.add_argument("--layers", nargs="+", required=True, help="layers to export, e.g. 6 202/0")
+    parser.add_argument("--area-size", type=float, nargs="+", required=True, help="size of the exposure area in um, or its width and height")
+    parser.add_argument("--field-size", type=float, nargs="+", required=True, help="writing field size in um, or its width and height")
+    parser.add_argument("--x-left", type=float, default=0.0, help="left edge of the exposure area in um (default: 0)")
+    parser.add_argument("--y-bottom", type=float, default=0.0, help="bottom edge of the exposure area in um (default: 0)")
+    parser.add_argument("--output", required=True, help="output directory (files mode) or layout file (cells mode)")
+    parser.add_argument("--mode", choices=("files", "cells"), default="files", help="one file per field, or one cell per field (default: files)")
+    parser.add_argument("--origin", choices=ORIGINS, default="lower-left", help="field-local origin (default: lower-left)")
+    parser.add_argument("--format", choices=("oas", "gds"), default="oas", help="format of the field files (default: oas)")
+    parser.add_argument("--top-cell", default=None, help="cell to export (default: the single top cell)")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--manifest", default=None, help="JSON manifest (default: manifest.json in the output directory, or <output>.json)")
+    args = parser.parse_args(argv)
+
+    if len(args.area_size) > 2 or len(args.field_size) > 2:
+        parser.error("--area-size and --field-size take one or two values")
+    area_size = args.area_size[0] if len(args.area_size) == 1 else tuple(args.area_size)
+    field_size = args.field_size[0] if len(args.field_size) == 1 else tuple(args.field_size)
+    manifest = export_fields(args.input, args.layers,
+                             area_size, field_size, args.x_left, args.y_bottom, args.output,
+                             mode=args.mode, origin=args.origin, extension="." + args.format,
+                             top_cell=args.top_cell, processes=args.processes)
+
+    manifest_path = args.manifest
+    if manifest_path is None:
+        manifest_path = os.path.join(args.output, "manifest.json") if args.mode == "files" else args.output + ".json"
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    exported = sum(1 for entry in manifest["fields"] if entry["total_polygons"] > 0)
+    print(f"{exported} of {len(manifest['fields'])} field(s) exported in {manifest['clip_time']:.2f} s "
+          f"with {manifest['processes']} process(es), manifest written to {manifest_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# Search the placement of the writing-field lattice (the `x_left`/`y_bottom` of `create_grid`)
+# which gives the fewest and narrowest electrode crossings, i.e. the fewest stitches.
+#
+# The score of an offset is the sum of a part for the vertical lines, which only depends on
+# the x offset, and a part for the horizontal lines, which only depends on the y offset. Each
+# part is computed for all candidate offsets at once: the edges of the merged electrodes are
+# indexed once as numpy arrays, and the covered length of every line is summed in closed form
+# over the arithmetic progression of line positions, folded modulo the field pitch. The cost is
+# linear in the number of edges plus the number of candidates, so an exhaustive dbu-step sweep
+# over a whole pitch is feasible.
+#
+# usage example:
+#   python offset_optimizer.py chip.gds --electrode-layer 6 --area-size 5000 --field-size 100 \
+#       --x-left 0 --y-bottom 0 --step 0.1 --output offsets.json
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+
+# -----------------------------------------------------------------------------
+import argparse
+import json
+import multiprocessing
+import time
+
+import numpy
+import pya
+from patching import lattice_axes
+from auto_klayout_toolkit import layer_info, layer_load_options # importing patching put it on sys.path
+
+
+class EdgeIndex:
+    """
+    Edges of the merged electrodes as numpy arrays x1, y1, x2, y2 (dbu), built once and
+    reused for both axes and all offsets. The polygon hulls of KLayout run clockwise (holes
+    counter-clockwise), so the interior is on the right of every edge.
+    """
+    def __init__(self, region):
+        coordinates = []
+        for polygon in region.merged().each():
+            for edge in polygon.each_edge():
+                coordinates.append((edge.p1.x, edge.p1.y, edge.p2.x, edge.p2.y))
+        array = numpy.array(coordinates, dtype=numpy.float64).reshape(-1, 4)
+        self.x1, self.y1, self.x2, self.y2 = array.T
+
+    def __len__(self):
+        return len(self.x1)
+
+    def axis(self, vertical_lines):
+        """
+        Edges as (a1, b1, a2, b2, sign) for lines of constant a: a is x for vertical lines and
+        y for horizontal ones. An edge with sign +1 lies on the upper (resp. lower) end of a
+        covered interval, one with -1 on the other end, so the covered length of a line is the
+        signed sum of the b of the edges it crosses, and the number of covered intervals the
+        number of edges with sign +1.
+        """
+        if vertical_lines:
+            # interior on the right: an edge running in +x has the interior below it
+            a1, b1, a2, b2 = self.x1, self.y1, self.x2, self.y2
+            sign = numpy.sign(a2 - a1)
+        else:
+            # an edge running in +y has the interior on its right, i.e. at larger x
+            a1, b1, a2, b2 = self.y1, self.x1, self.y2, self.x2
+            sign = -numpy.sign(a2 - a1)
+        keep = a1 != a2
+        return a1[keep], b1[keep], a2[keep], b2[keep], sign[keep]
+
+
+def fold_linear(u0, u1, c0, c1, buckets):
+    """
+    For every j in 0 ... buckets - 1 the sum of c0 + c1 * u over all integers u in [u0, u1)
+    with u % buckets == j, accumulated over all entries of the arrays u0, u1, c0, c1.
+    Ranges are split into a partial first period, whole periods (adding a linear function of j
+    to every bucket) and a partial last period (difference arrays).
+    """
+    ranges = u1 > u0
+    u0, u1, c0, c1 = u0[ranges], u1[ranges], c0[ranges], c1[ranges]
+    q0 = u0 // buckets
+    q1 = u1 // buckets
+    j0 = u0 - q0 * buckets
+    j1 = u1 - q1 * buckets
+
+    # constant (A) and slope (B) of c0 + c1 * (q * buckets + j) = A + B * j on bucket ranges
+    diff_a = numpy.zeros(buckets + 1)
+    diff_b = numpy.zeros(buckets + 1)
+    def add_range(ja, jb, q, c0, c1):
+        a = c0 + c1 * q * buckets
+        numpy.add.at(diff_a, ja, a)
+        numpy.add.at(diff_a, jb, -a)
+        numpy.add.at(diff_b, ja, c1)
+        numpy.add.at(diff_b, jb, -c1)
+
+    single = q0 == q1
+    add_range(j0[single], j1[single], q0[single], c0[single], c1[single])
+    multi = ~single
+    add_range(j0[multi], numpy.full(multi.sum(), buckets), q0[multi], c0[multi], c1[multi])
+    add_range(numpy.zeros(multi.sum(), dtype=numpy.int64), j1[multi], q1[multi], c0[multi], c1[multi])
+
+    # whole periods q0 + 1 ... q1 - 1
+    periods = (q1 - q0 - 1)[multi]
+    q_sum = (q0[multi] + q1[multi]) * periods / 2
+    constant = (periods * c0[multi] + c1[multi] * buckets * q_sum).sum()
+    slope = (c1[multi] * periods).sum()
+
+    j = numpy.arange(buckets)
+    return numpy.cumsum(diff_a)[:buckets] + constant + (numpy.cumsum(diff_b)[:buckets] + slope) * j
+
+
+def axis_scores_chunk(task):
+    """
+    Covered length and crossing count of the lines of one axis for all candidate offsets,
+    for one chunk of edges (runs in a worker process).
+    """
+    a1, b1, a2, b2, sign, origin, step, buckets, window = task
+    a_min = numpy.minimum(a1, a2)
+    a_max = numpy.maximum(a1, a2)
+    # line u (at origin + u * step) crosses the edge if a_min <= origin + u * step < a_max
+    u0 = numpy.clip(numpy.ceil((a_min - origin) / step), 0, window).astype(numpy.int64)
+    u1 = numpy.clip(numpy.ceil((a_max - origin) / step), 0, window).astype(numpy.int64)
+    slope = (b2 - b1) / (a2 - a1)
+    # b on line u: b1 + (origin + u * step - a1) * slope
+    c0 = sign * (b1 + (origin - a1) * slope)
+    c1 = sign * step * slope
+    length = fold_linear(u0, u1, c0, c1, buckets)
+    upper = sign > 0
+    count = fold_linear(u0[upper], u1[upper], numpy.ones(upper.sum()), numpy.zeros(upper.sum()), buckets)
+    return length, count
+
+
+def axis_scores(edge_index, vertical_lines, axis, step_dbu, processes=1):
+    """
+    Total covered length (dbu) and number of crossings of the inner lines of one lattice axis
+    (start, pitch, count, length from `lattice_axes`) for the offsets 0, step_dbu, ... < pitch.
+    The lines are taken as infinitely long, i.e. the exposure area is assumed to cover the
+    electrodes for all offsets.
+    """
+    start, pitch, count, _ = axis
+    buckets = pitch // step_dbu
+    # for offset j * step the lines lie at start + j * step + i * pitch, i = 1 ... count - 1,
+    # i.e. at origin + u * step for u in [0, window) with j = u % buckets
+    origin = start + pitch
+    window = (count - 1) * buckets
+    a1, b1, a2, b2, sign = edge_index.axis(vertical_lines)
+
+    chunks = max(1, min(processes, len(a1) // 10000))
+    tasks = [(a1[k::chunks], b1[k::chunks], a2[k::chunks], b2[k::chunks], sign[k::chunks],
+              origin, step_dbu, buckets, window) for k in range(chunks)]
+    if chunks > 1:
+        with multiprocessing.Pool(chunks) as pool:
+            results = pool.map(axis_scores_chunk, tasks)
+    else:
+        results = [axis_scores_chunk(task) for task in tasks]
+    return sum(result[0] for result in results), numpy.rint(sum(result[1] for result in results))
+
+
+def optimize_offset(region, dbu, area_size, field_size, x_left, y_bottom, grid_line_width=1.0, step=None,
+                    width_weight=0.01, processes=None, map_limit=1000):
+    """
+    Find the offset (dx, dy) in [0, field pitch) of the lattice of `create_grid` which
+    minimizes  crossings + width_weight * crossing width (um, summed over all crossings)
+    for the electrodes in `region` (a pya.Region, or an EdgeIndex to reuse the index of an
+    earlier call). The crossings are counted on the line centers, the width of a crossing is
+    the covered length of the line plus the line width.
+    `step` (um, default: the pitch / 1000, at least one dbu) is rounded to a divisor of the
+    pitch in dbu. Returns a dictionary with the best offset (um), its score and counts, the
+    score of every candidate per axis and, if the candidates per axis are at most `map_limit`,
+    the full score map (list of rows, one per y offset).
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    x_axis, y_axis = lattice_axes(dbu, area_size, field_size, x_left, y_bottom)
+    grid_line_width_dbu = round(grid_line_width / dbu)
+
+    t_start = time.perf_counter()
+    edge_index = region if isinstance(region, EdgeIndex) else EdgeIndex(region)
+    index_time = time.perf_counter() - t_start
+
+    scores = []
+    for vertical_lines, axis in ((True, x_axis), (False, y_axis)):
+        pitch = axis[1]
+        step_dbu = max(1, min(pitch, round(step / dbu) if step else pitch // 1000))
+        while pitch % step_dbu:
+            step_dbu -= 1
+        length, count = axis_scores(edge_index, vertical_lines, axis, step_dbu, processes)
+        width = (length + count * grid_line_width_dbu) * dbu
+        offsets = numpy.arange(pitch // step_dbu) * step_dbu * dbu
+        scores.append((offsets, count + width_weight * width, count, width))
+    (x_offsets, x_scores, x_count, x_width), (y_offsets, y_scores, y_count, y_width) = scores
+    search_time = time.perf_counter() - t_start - index_time
+
+    ix = int(numpy.argmin(x_scores))
+    iy = int(numpy.argmin(y_scores))
+    result = {"x_offset": float(x_offsets[ix]),
+              "y_offset": float(y_offsets[iy]),
+              "x_left": x_left + float(x_offsets[ix]),
+              "y_bottom": y_bottom + float(y_offsets[iy]),
+              "score": float(x_scores[ix] + y_scores[iy]),
+              "crossings": int(x_count[ix] + y_count[iy]),
+              "crossing_width": float(x_width[ix] + y_width[iy]),
+              "candidates": len(x_offsets) * len(y_offsets),
+              "edges": len(edge_index),
+              "index_time": index_time,
+              "search_time": search_time,
+              "x_offsets": x_offsets.tolist(),
+              "x_scores": x_scores.tolist(),
+              "y_offsets": y_offsets.tolist(),
+              "y_scores": y_scores.tolist()}
+    if len(x_offsets) <= map_limit and len(y_offsets) <= map_limit:
+        result["score_map"] = (y_scores[:, None] + x_scores[None, :]).tolist()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the writing-field lattice offset with the fewest electrode crossings.")
+    parser.add_argument("input", help="layout file")
+    parser.add_argument("--electrode-layer", required=True, help="electrode layer, e.g. 6 or 6/0")
+    parser.add_argument("--area-size", type=float, nargs="+", required=True, help="size of the exposure area in um, or its width and height")
+    parser.add_argument("--field-size", type=float, nargs="+", required=True, help="writing field size in um, or its width and height")
+    parser.add_argument("--x-left", type=float, default=0.0, help="left edge of the unshifted exposure area in um (default: 0)")
+    parser.add_argument("--y-bottom", type=float, default=0.0, help="bottom edge of the unshifted exposure area in um (default: 0)")
+    parser.add_argument("--grid-width", type=float, default=1.0, help="grid line width in um (default: 1)")
+    parser.add_argument("--step", type=float, default=None, help="offset step in um (default: the field size / 1000)")
+    parser.add_argument("--width-weight", type=float, default=0.01, help="score per um of crossing width, one crossing scores 1 (default: 0.01)")
+    parser.add_argument("--hierarchical", action="store_true", help="include shapes of child cells")
+    parser.add_argument("--top-cell", default=None, help="cell to use (default: the single top cell)")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--output", default=None, help="JSON file for the result and the scores")
+    args = parser.parse_args(argv)
+
+    if len(args.area_size) > 2 or len(args.field_size) > 2:
+        parser.error("--area-size and --field-size take one or two values")
+    area_size = args.area_size[0] if len(args.area_size) == 1 else tuple(args.area_size)
+    field_size = args.field_size[0] if len(args.field_size) == 1 else tuple(args.field_size)
+
+    electrode_layer = layer_info(args.electrode_layer)
+    layout = pya.Layout()
+    layout.read(args.input, layer_load_options([electrode_layer]))
+    cell = layout.cell(args.top_cell) if args.top_cell else layout.top_cell()
+    if cell is None:
+        parser.error(f"cell '{args.top_cell}' not found")
+    layer_index = layout.find_layer(electrode_layer)
+    if layer_index is None:
+        parser.error(f"layer {args.electrode_layer} not found")
+    region = pya.Region(cell.begin_shapes_rec(layer_index)) if args.hierarchical else pya.Region(cell.shapes(layer_index))
+
+    result = optimize_offset(region, layout.dbu, area_size, field_size, args.x_left, args.y_bottom,
+                             args.grid_width, args.step, args.width_weight, args.processes)
+    print(f"{result['candidates']} offsets of {result['edges']} edges searched in {result['search_time']:.2f} s "
+          f"(edge index {result['index_time']:.2f} s)")
+    print(f"Best offset: x_left = {result['x_left']:g} um, y_bottom = {result['y_bottom']:g} um, "
+          f"{result['crossings']} crossings, {result['crossing_width']:.1f} um crossing width")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file)
+        print(f"Scores written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# On-disk cache of patching results. The key is a hash of the normalized input geometry
+# (writing fields, electrodes, existing grid) and all parameters, the value the generated
+# grid and patch shapes as a compact OASIS blob. A cache hit skips the boolean work entirely.
+# The cache directory is limited in size, the least recently used entries are evicted first.
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+
+# -----------------------------------------------------------------------------
+import hashlib
+import json
+import tempfile
+
+import pya
+from patching import create_grid_from_shapes, create_patch, create_patch_tiled
+from auto_klayout_toolkit import find_or_create_layer, layer_info, log, span # importing patching put it on sys.path
+
+# layers of the scratch layout and of the cached blobs
+FIELD_LAYER = pya.LayerInfo(1, 0)
+ELECTRODE_LAYER = pya.LayerInfo(2, 0)
+GRID_LAYER = pya.LayerInfo(3, 0)
+PATCH_LAYER = pya.LayerInfo(4, 0)
+
+
+def region_digest(region):
+    """
+    sha256 hex digest of the shapes of a Region, independent of their order and duplicates.
+    The shapes are not merged: that would cost about as much as the patching itself.
+    """
+    digest = hashlib.sha256()
+    for text in sorted(set(str(polygon) for polygon in region.each())):
+        digest.update(text.encode())
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+class PatchCache:
+    """
+    Content-addressed store of OASIS blobs in `directory`, limited to `max_bytes`.
+    Every instance counts its hits, misses and evictions; several processes may share
+    one directory.
+    """
+    def __init__(self, directory, max_bytes=1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".oas")
+
+    def get(self, key):
+        """
+        The blob stored under `key`, or None. A hit marks the entry as recently used.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                blob = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return blob
+
+    def put(self, key, blob):
+        """
+        Store `blob` under `key`, then evict old entries beyond the size limit.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so other processes never read a partial blob
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            file.write(blob)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def entries(self):
+        """
+        (last use time, size, path) of all entries, least recently used first.
+        """
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".oas"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits into `max_bytes`.
+        """
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def stats(self):
+        """
+        Hit/miss statistics of this instance and the current size of the cache.
+        """
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(entry[1] for entry in entries)}
+
+
+def cached_grid_and_patch(cache, layout, cell, shape_layer, electrode_layer, grid_layer, patch_layer,
+                          grid_line_width, patch_size, shape_layer_datatype=0, electrode_layer_datatype=0,
+                          grid_layer_datatype=0, patch_layer_datatype=0, merge_patches=False,
+                          tile_size=0.0, threads=None, mode="center", patch_margin=1.0, tile_origin=None):
+    """
+    `create_grid_from_shapes` + `create_patch` (or `create_patch_tiled` with a `tile_size`,
+    which only supports the "center" `mode`) on the shapes of `cell` itself, with the result taken from `cache` (a PatchCache) if the
+    same input was patched before with the same parameters.
+    Returns True on a cache hit.
+    """
+    shape_layer_index = find_or_create_layer(layout, layer_info(shape_layer, shape_layer_datatype))
+    electrode_layer_index = find_or_create_layer(layout, layer_info(electrode_layer, electrode_layer_datatype))
+    grid_layer_index = find_or_create_layer(layout, layer_info(grid_layer, grid_layer_datatype))
+    patch_layer_index = find_or_create_layer(layout, layer_info(patch_layer, patch_layer_datatype))
+
+    with span("fingerprinting", function="cached_grid_and_patch") as s:
+        field_region = pya.Region(cell.shapes(shape_layer_index))
+        electrode_region = pya.Region(cell.shapes(electrode_layer_index))
+        existing_grid_region = pya.Region(cell.shapes(grid_layer_index))
+        # the layer numbers don't change the result, the tiles and threads only its speed (tiled
+        # and untiled patching give the same patches), so they are not part of the key
+        parameters = {"dbu": layout.dbu,
+                      "grid_line_width": grid_line_width,
+                      "patch_size": patch_size,
+                      "merge_patches": merge_patches,
+                      "mode": mode,
+                      "patch_margin": patch_margin}
+        digest = hashlib.sha256()
+        digest.update(json.dumps(parameters, sort_keys=True).encode())
+        digest.update(region_digest(field_region).encode())
+        digest.update(region_digest(electrode_region).encode())
+        digest.update(region_digest(existing_grid_region).encode())
+        key = digest.hexdigest()
+        s.inputs = field_region.count() + electrode_region.count() + existing_grid_region.count()
+
+    blob = cache.get(key)
+    if blob is None:
+        # patch a scratch copy of the inputs, so exactly the new shapes can be stored
+        scratch = pya.Layout()
+        scratch.dbu = layout.dbu
+        scratch_cell = scratch.create_cell("PATCHING")
+        scratch_cell.shapes(scratch.layer(FIELD_LAYER)).insert(field_region)
+        scratch_cell.shapes(scratch.layer(ELECTRODE_LAYER)).insert(electrode_region)
+        create_grid_from_shapes(scratch, scratch_cell, FIELD_LAYER.layer, GRID_LAYER.layer, grid_line_width)
+
+        result = pya.Layout()
+        result.dbu = layout.dbu
+        result_cell = result.create_cell("PATCHING")
+        result_cell.shapes(result.layer(GRID_LAYER)).insert(scratch_cell.shapes(scratch.layer(GRID_LAYER)))
+
+        scratch_cell.shapes(scratch.layer(GRID_LAYER)).insert(existing_grid_region)
+        if tile_size:
+            create_patch_tiled(scratch, scratch_cell, ELECTRODE_LAYER.layer, GRID_LAYER.layer, PATCH_LAYER.layer,
+                               patch_size, tile_size, threads=threads, tile_origin=tile_origin, merge_patches=merge_patches)
+        else:
+            create_patch(scratch, scratch_cell, ELECTRODE_LAYER.layer, GRID_LAYER.layer, PATCH_LAYER.layer,
+                         patch_size, merge_patches=merge_patches, mode=mode, patch_margin=patch_margin)
+        result_cell.shapes(result.layer(PATCH_LAYER)).insert(scratch_cell.shapes(scratch.layer(PATCH_LAYER)))
+
+        options = pya.SaveLayoutOptions()
+        options.format = "OASIS"
+        options.oasis_compression_level = 10
+        blob = result.write_bytes(options)
+        cache.put(key, blob)
+        hit = False
+    else:
+        result = pya.Layout()
+        result.read_bytes(blob)
+        result_cell = result.top_cell()
+        hit = True
+        log(f"Cache hit for {key[:12]}, grid and patches taken from the cache.")
+
+    with span("insertion", function="cached_grid_and_patch", cache_hit=hit) as s:
+        for scratch_layer_info, layer_index in ((GRID_LAYER, grid_layer_index), (PATCH_LAYER, patch_layer_index)):
+            result_layer_index = result.find_layer(scratch_layer_info)
+            if result_layer_index is not None:
+                cell.shapes(layer_index).insert(result_cell.shapes(result_layer_index))
+        s.outputs = cell.shapes(patch_layer_index).size()
+
+    log(f"Patches created on layer {layer_info(patch_layer, patch_layer_datatype)}.")
+    return hit
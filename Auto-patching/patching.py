@@ -1,6 +1,10 @@
 # add parent directory to sys.path to import auto_klayout_toolkit.py
+import hashlib
+import json
+import math
 import os
 import sys
+import time
 script_path = os.path.abspath(__file__)
 current_dir = os.path.dirname(script_path)
 parent_dir = os.path.dirname(current_dir)
@@ -10,108 +14,1047 @@ if parent_dir not in sys.path:
 
 # -----------------------------------------------------------------------------
 import pya
-from auto_klayout_toolkit import find_or_create_layer
+from auto_klayout_toolkit import LayoutSession, find_or_create_layer, layer_info, log, span
+
+try:
+    import numpy # optional, for computing large lattices
+except ImportError:
+    numpy = None
+
+PATCH_MODES = ("center", "adaptive")
+
+
+def patch_box(center, patch_size_dbu):
+    """
+    Square patch of `patch_size_dbu` centered at `center` (a pya.Point).
+    """
+    p1 = pya.Point(center.x - patch_size_dbu//2, center.y - patch_size_dbu//2)
+    p2 = pya.Point(center.x + patch_size_dbu//2, center.y + patch_size_dbu//2)
+    return pya.Box(p1, p2)
+
+
+class TiledPatchReceiver(pya.TileOutputReceiver):
+    """
+    Collects the patches of a TilingProcessor run. A tile only keeps the intersections
+    whose center lies inside the tile (left/bottom edge inclusive, right/top exclusive),
+    so intersections seen by several tiles through the tile border yield one patch.
+    Intersections reaching from the tile to the outer edge of its border (`border_dbu`) may
+    be incomplete: they get no patch, their bounding boxes are collected in `truncated`.
+    """
+    def __init__(self, patch_size_dbu, border_dbu):
+        self.patch_size_dbu = patch_size_dbu
+        self.border_dbu = border_dbu
+        self.patches = []
+        self.truncated = []
+        self.intersection_count = 0
+
+    def put(self, ix, iy, tile, obj, dbu, clip):
+        frame = tile.enlarged(self.border_dbu, self.border_dbu)
+        for polygon in obj.each():
+            # the electrodes are only complete within the frame
+            if polygon.bbox().touches(tile) and not window_interior(frame, polygon.bbox()):
+                self.truncated.append(polygon.bbox())
+                continue
+            center = polygon.bbox().center()
+            if tile.left <= center.x < tile.right and tile.bottom <= center.y < tile.top:
+                self.intersection_count += 1
+                self.patches.append(patch_box(center, self.patch_size_dbu))
+
+
+def insert_patches(cell, layer_index, patches, merge_patches=False):
+    """
+    Insert a list of patch boxes with one bulk call. Exact duplicates are dropped; with 
+    `merge_patches=True` overlapping patches are merged into one polygon.
+    Returns the number of shapes inserted.
+    """
+    patch_region = pya.Region(list(dict.fromkeys(patches)))
+    if merge_patches:
+        patch_region.merge()
+    cell.shapes(layer_index).insert(patch_region)
+    return patch_region.count()
+
+
+def adaptive_patches(electrode_region, crossing_region, patch_size_dbu, margin_dbu):
+    """
+    Patches following the local geometry of every crossing: the part of the electrode within
+    `patch_size_dbu`/2 of the crossing, grown by `margin_dbu`. Wide leads are covered over
+    their full width, diagonal leads along their direction, and crossings at field corners
+    in both directions. Computed with Region operations over all crossings at once.
+    `electrode_region` may be clipped to the grid sized by `patch_size_dbu`/2 beforehand,
+    which keeps the second boolean small.
+    """
+    reach_region = crossing_region.sized(patch_size_dbu // 2, 5)
+    piece_region = (electrode_region & reach_region).interacting(crossing_region)
+    return piece_region.sized(margin_dbu)
+
+
+def flat_region(region):
+    """
+    Flat, merged copy of a deep-mode Region. The grid lies in the top cell and crosses every
+    child cell in another place, so a deep boolean with it would compute every cell context
+    on its own and split the results; flat Regions are faster and give the same patches as
+    a flattened layout.
+    """
+    flat = pya.Region()
+    flat.insert(region)
+    flat.merge()
+    return flat
+
+
+def grid_from_shapes(shape_region, grid_line_width_dbu):
+    """
+    Merged grid lines of `grid_line_width_dbu` along the edges of all shapes in `shape_region`.
+    Edges are extended at both ends by half the line width instead of being joined,
+    which closes the corners the same way for rectangular writing fields.
+    Returns the grid Region and the number of edges extended.
+    """
+    # Merged semantics is switched off, otherwise abutting writing fields would be merged 
+    # and their common boundary lost.
+    shape_region.merged_semantics = False
+    all_edges = shape_region.edges()
+    all_edges.merged_semantics = False # keep coincident edges of neighbouring fields
+    half_width_dbu = grid_line_width_dbu // 2
+    grid_region = all_edges.extended(half_width_dbu, half_width_dbu, half_width_dbu, half_width_dbu, False)
+    grid_region.merge()
+    return grid_region, all_edges.count()
+
 
 def create_grid_from_shapes(layout, cell, shape_layer, grid_layer, grid_line_width, 
-                            shape_layer_datatype=0, grid_layer_datatype=0):
+                            shape_layer_datatype=0, grid_layer_datatype=0, hierarchical=False, session=None):
     """
     Create a grid with `grid_line_width` along the edges of all shapes on `shape_layer`.
+    All edges are collected in one pass and extended/merged once, so the cost grows
+    roughly linearly with the number of writing-field shapes.
+    With `hierarchical=True` the shapes of child cells are included (deep mode).
+    With a `session` (a LayoutSession) the layers and shapes are taken from it, and the
+    new grid is kept there for the next call.
     """
+    if session is None:
+        session = LayoutSession(layout, cell)
     # Get the database unit (dbu) for unit conversion
     dbu = layout.dbu
     grid_line_width_dbu = int(grid_line_width / dbu)
 
     # Get layer indices
-    shape_layer_index = find_or_create_layer(layout, pya.LayerInfo(shape_layer, shape_layer_datatype))
-    grid_layer_index = find_or_create_layer(layout, pya.LayerInfo(grid_layer, grid_layer_datatype))
-
-    # For every shape, find its edges and extend them to create grid lines, 
-    # and finally combine all grid regions.
-    final_grid_region = pya.Region()
-    for shape in cell.shapes(shape_layer_index):
-        edges = pya.Region(shape.polygon).edges() # standard way to get edges from any shapes
-        grid_region = edges.extended(0, 0, grid_line_width_dbu//2, grid_line_width_dbu//2, True)
-        final_grid_region |= grid_region
-    
+    shape_layer_index = session.layer(shape_layer, shape_layer_datatype)
+    grid_layer_index = session.layer(grid_layer, grid_layer_datatype)
+
+    with span("region building", function="create_grid_from_shapes") as s:
+        shape_region = session.region(shape_layer_index, cell, hierarchical, merged=False)
+        s.outputs = shape_region.count()
+
+    # Collect the edges of all shapes at once, extend them to grid lines in one go
+    # and merge the result once
+    with span("edge extension", function="create_grid_from_shapes") as s:
+        final_grid_region, s.inputs = grid_from_shapes(shape_region, grid_line_width_dbu)
+        s.outputs = final_grid_region.count()
+
     # Insert the final grid region into the grid layer
-    cell.shapes(grid_layer_index).insert(final_grid_region)
+    with span("insertion", function="create_grid_from_shapes") as s:
+        session.insert(grid_layer_index, final_grid_region, cell)
+        s.outputs = final_grid_region.count()
 
-    print(f"Grid created on layer {pya.LayerInfo(grid_layer, grid_layer_datatype)} based on shapes from layer {pya.LayerInfo(shape_layer, shape_layer_datatype)}.")
+    log(f"Grid created on layer {layer_info(grid_layer, grid_layer_datatype)} based on shapes from layer {layer_info(shape_layer, shape_layer_datatype)}.")
 
     return
 
 
 def create_patch(layout, cell, electrode_layer, grid_layer, patch_layer, patch_size,
-                 electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0):
+                 electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                 hierarchical=False, merge_patches=False, mode="center", patch_margin=1.0, session=None):
     """
     Create patches at the center of intersections between electrode and grid layers.
-    Datatype for all layers must be 0.
+    With `hierarchical=True` the electrodes and grid are taken from the whole cell tree
+    and flattened (see `flat_region`), the patches are placed in `cell`, the same as for a
+    flattened layout.
+    With `merge_patches=True` overlapping patches are merged into one shape.
+    With `mode="adaptive"` the patches are not squares but cover the electrode `patch_size`/2
+    around each intersection and `patch_margin` (um) beyond its edges, see `adaptive_patches`;
+    they are always merged.
+    With a `session` (a LayoutSession) the layers and the merged electrodes and grid are
+    taken from it, e.g. the grid of a previous `create_grid_from_shapes`.
     """
+    if mode not in PATCH_MODES:
+        raise ValueError(f"Unknown patch mode '{mode}'.")
+    if session is None:
+        session = LayoutSession(layout, cell)
     # Get the database unit (dbu) for unit conversion
     dbu = layout.dbu
     patch_size_dbu = int(patch_size / dbu)
+    margin_dbu = int(patch_margin / dbu)
 
     # Get layer indices
-    electrode_layer_index = find_or_create_layer(layout, pya.LayerInfo(electrode_layer, electrode_layer_datatype))
-    grid_layer_index = find_or_create_layer(layout, pya.LayerInfo(grid_layer, grid_layer_datatype))
-    patch_layer_index = find_or_create_layer(layout, pya.LayerInfo(patch_layer, patch_layer_datatype))
+    electrode_layer_index = session.layer(electrode_layer, electrode_layer_datatype)
+    grid_layer_index = session.layer(grid_layer, grid_layer_datatype)
+    patch_layer_index = session.layer(patch_layer, patch_layer_datatype)
 
     # Create Regions for boolean operations
-    electrode_regioin = pya.Region(cell.shapes(electrode_layer_index))
-    grid_region = pya.Region(cell.shapes(grid_layer_index))
+    with span("region building", function="create_patch") as s:
+        electrode_regioin = session.region(electrode_layer_index, cell, hierarchical)
+        grid_region = session.region(grid_layer_index, cell, hierarchical)
+        if hierarchical:
+            electrode_regioin = flat_region(electrode_regioin)
+            grid_region = flat_region(grid_region)
+        s.outputs = electrode_regioin.count() + grid_region.count()
 
     # Find intersections
-    intersection_region = electrode_regioin & grid_region
+    with span("boolean", function="create_patch") as s:
+        s.inputs = electrode_regioin.count() + grid_region.count()
+        if mode == "adaptive":
+            # one boolean with the whole electrode layer: clip it to the reach of the patches
+            electrode_regioin = electrode_regioin & grid_region.sized(patch_size_dbu // 2)
+        intersection_region = electrode_regioin & grid_region
+        s.outputs = intersection_region.count()
 
     # Create patches at the center of intersections
     if intersection_region.is_empty():
-        print("Warning: No intersections found between the electrode layer and the grid layer.")
-    for intersection_shape in intersection_region.each():
-        center = intersection_shape.bbox().center()
-        p1 = pya.Point(center.x - patch_size_dbu//2, center.y - patch_size_dbu//2)
-        p2 = pya.Point(center.x + patch_size_dbu//2, center.y + patch_size_dbu//2)
-        cell.shapes(patch_layer_index).insert(pya.Box(p1, p2))
-
-    print(f"Patches created on layer {pya.LayerInfo(patch_layer, patch_layer_datatype)}.")
+        log("Warning: No intersections found between the electrode layer and the grid layer.")
+    with span("patch generation", function="create_patch", mode=mode) as s:
+        if mode == "adaptive":
+            patch_region = adaptive_patches(electrode_regioin, intersection_region, patch_size_dbu, margin_dbu)
+            s.outputs = patch_region.count()
+        else:
+            patches = [patch_box(shape.bbox().center(), patch_size_dbu) for shape in intersection_region.each()]
+            s.outputs = len(patches)
+        s.inputs = intersection_region.count()
+
+    with span("insertion", function="create_patch") as s:
+        if mode == "adaptive":
+            session.insert(patch_layer_index, patch_region, cell)
+            s.outputs = patch_region.count()
+        else:
+            s.inputs = len(patches)
+            s.outputs = insert_patches(cell, patch_layer_index, patches, merge_patches)
+
+    log(f"Patches created on layer {layer_info(patch_layer, patch_layer_datatype)}.")
     
     return
 
 
+def create_patch_multi(layout, cell, shape_layer, electrode_layers, grid_layer, patch_layer, grid_line_width, patch_sizes,
+                       shape_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                       hierarchical=False, merge_patches=False, mode="center", patch_margin=1.0, session=None):
+    """
+    `create_grid_from_shapes` + `create_patch` for several electrode layers and patch sizes in
+    one pass: the grid is built once, every electrode layer is intersected with it once and
+    the patches of all sizes are derived from the same intersections.
+    `electrode_layers` are anything `layer_info` takes, e.g. 6, "6/0" or (6, 0). The patches go to
+    consecutive layers starting at `patch_layer`, first all sizes of the first electrode layer,
+    then those of the second one, and so on; the writing field, grid and electrode layers
+    are skipped. Repeated electrode layers or patch sizes are patched once.
+    Layers and shapes are taken from `session` (a LayoutSession) if given.
+    Returns a dictionary {(electrode layer as given, patch size): patch pya.LayerInfo}.
+    """
+    if mode not in PATCH_MODES:
+        raise ValueError(f"Unknown patch mode '{mode}'.")
+    if session is None:
+        session = LayoutSession(layout, cell)
+    # Get the database unit (dbu) for unit conversion
+    dbu = layout.dbu
+    grid_line_width_dbu = int(grid_line_width / dbu)
+    margin_dbu = int(patch_margin / dbu)
+    # repeated layers or sizes are patched once, not onto one more layer each
+    unique_layers = {}
+    for layer in electrode_layers:
+        unique_layers.setdefault(str(layer_info(layer)), layer)
+    electrode_layers = list(unique_layers.values())
+    electrode_layer_infos = [layer_info(layer) for layer in electrode_layers]
+    patch_sizes = list(dict.fromkeys(patch_sizes))
+
+    # Get layer indices
+    shape_layer_index = session.layer(shape_layer, shape_layer_datatype)
+    grid_layer_index = session.layer(grid_layer, grid_layer_datatype)
+
+    # output layers, never one of the input layers or the grid
+    input_layers = {str(layer_info(shape_layer, shape_layer_datatype)), str(layer_info(grid_layer, grid_layer_datatype))}
+    input_layers |= {str(info) for info in electrode_layer_infos}
+    first_patch_layer_info = layer_info(patch_layer, patch_layer_datatype)
+    patch_layer_infos = []
+    number = first_patch_layer_info.layer
+    while len(patch_layer_infos) < len(electrode_layers) * len(patch_sizes):
+        patch_layer_info = pya.LayerInfo(number, first_patch_layer_info.datatype)
+        if str(patch_layer_info) in input_layers:
+            log(f"Layer {patch_layer_info} is an input or grid layer, the patches go to the next layer.")
+        else:
+            patch_layer_infos.append(patch_layer_info)
+        number += 1
+
+    with span("edge extension", function="create_patch_multi") as s:
+        shape_region = session.region(shape_layer_index, cell, hierarchical, merged=False)
+        grid_region, s.inputs = grid_from_shapes(shape_region, grid_line_width_dbu)
+        s.outputs = grid_region.count()
+    with span("insertion", function="create_patch_multi") as s:
+        session.insert(grid_layer_index, grid_region, cell)
+        s.outputs = grid_region.count()
+    if hierarchical:
+        grid_region = flat_region(grid_region)
+
+    outputs = {}
+    free_patch_layer_infos = iter(patch_layer_infos)
+    for electrode_layer, electrode_layer_info in zip(electrode_layers, electrode_layer_infos):
+        electrode_layer_index = session.layer(electrode_layer_info)
+
+        with span("boolean", function="create_patch_multi", layer=str(electrode_layer_info)) as s:
+            electrode_region = session.region(electrode_layer_index, cell, hierarchical)
+            if hierarchical:
+                electrode_region = flat_region(electrode_region)
+            s.inputs = electrode_region.count() + grid_region.count()
+            if mode == "adaptive":
+                # one boolean with the whole electrode layer: clip it to the reach of the largest patches
+                electrode_region = electrode_region & grid_region.sized(int(max(patch_sizes) / dbu) // 2)
+            intersection_region = electrode_region & grid_region
+            s.outputs = intersection_region.count()
+        if intersection_region.is_empty():
+            log(f"Warning: No intersections found between layer {electrode_layer_info} and the grid layer.")
+        # the patch centers are the same for all sizes
+        centers = [] if mode == "adaptive" else [polygon.bbox().center() for polygon in intersection_region.each()]
+
+        for patch_size in patch_sizes:
+            patch_size_dbu = int(patch_size / dbu)
+            patch_layer_info = next(free_patch_layer_infos)
+            patch_layer_index = session.layer(patch_layer_info)
+            with span("patch generation", function="create_patch_multi", patch_size=patch_size, mode=mode) as s:
+                s.inputs = intersection_region.count()
+                if mode == "adaptive":
+                    patch_region = adaptive_patches(electrode_region, intersection_region, patch_size_dbu, margin_dbu)
+                    session.insert(patch_layer_index, patch_region, cell)
+                    s.outputs = patch_region.count()
+                else:
+                    patches = [patch_box(center, patch_size_dbu) for center in centers]
+                    s.outputs = insert_patches(cell, patch_layer_index, patches, merge_patches)
+            outputs[(electrode_layer, patch_size)] = patch_layer_info
+            log(f"Patches of {patch_size} um for layer {electrode_layer_info} created on layer {patch_layer_info}.")
+
+    return outputs
+
+
+def create_patch_tiled(layout, cell, electrode_layer, grid_layer, patch_layer, patch_size,
+                       tile_size, threads=None, tile_origin=None, tile_border=None,
+                       electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                       merge_patches=False, hierarchical=False):
+    """
+    Same as `create_patch`, but the layout is cut into tiles of `tile_size` (um) which are
+    processed on `threads` worker threads (default: all cores) by a pya.TilingProcessor.
+    As for `create_patch`, shapes of child cells are only included with `hierarchical=True`
+    (flattened per tile).
+
+    Use the writing field size as `tile_size` and the lower-left corner of the writing fields
+    as `tile_origin` (um, default: the lower-left corner of the grid): the tiles are shifted by
+    half a tile against the fields, so tile edges run through the middle of the fields and
+    rarely cut an intersection. Electrodes are merged per tile, so `tile_border` (um, default:
+    a tenth of `tile_size`) should be larger than half of the widest (merged) electrode crossing
+    a grid line: intersections reaching the outer edge of the border are computed again
+    without tiles (see `complete_crossings`), so the patches are the same as those of
+    `create_patch`, but this is slow for many of them.
+    """
+    # Get the database unit (dbu) for unit conversion
+    dbu = layout.dbu
+    patch_size_dbu = int(patch_size / dbu)
+    if tile_border is None:
+        tile_border = tile_size / 10
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    # Get layer indices
+    electrode_layer_index = find_or_create_layer(layout, layer_info(electrode_layer, electrode_layer_datatype))
+    grid_layer_index = find_or_create_layer(layout, layer_info(grid_layer, grid_layer_datatype))
+    patch_layer_index = find_or_create_layer(layout, layer_info(patch_layer, patch_layer_datatype))
+
+    # The tile field starts at its origin, so move the origin (in steps of whole tiles)
+    # to the lower-left of the layout to cover everything
+    bbox = cell.dbbox()
+    if tile_origin is None:
+        grid_bbox = cell.dbbox_per_layer(grid_layer_index)
+        tile_origin = (grid_bbox.left, grid_bbox.bottom) if not grid_bbox.empty() else (0, 0)
+    x_origin = tile_origin[0] + tile_size / 2
+    y_origin = tile_origin[1] + tile_size / 2
+    x_origin += math.floor((bbox.left - x_origin) / tile_size) * tile_size
+    y_origin += math.floor((bbox.bottom - y_origin) / tile_size) * tile_size
+
+    receiver = TiledPatchReceiver(patch_size_dbu, round(tile_border / dbu))
+    with span("boolean", function="create_patch_tiled", threads=threads, tile_size=tile_size) as s:
+        tiling_processor = pya.TilingProcessor()
+        tiling_processor.input("electrode", shape_iterator(cell, electrode_layer_index, hierarchical))
+        tiling_processor.input("grid", shape_iterator(cell, grid_layer_index, hierarchical))
+        tiling_processor.output("patches", receiver)
+        tiling_processor.tile_size(tile_size, tile_size)
+        tiling_processor.tile_origin(x_origin, y_origin)
+        tiling_processor.tile_border(tile_border, tile_border)
+        tiling_processor.threads = threads
+        # false: don't clip the intersections to the tile, the receiver picks them by their center
+        tiling_processor.queue("_output(patches, electrode & grid, false)")
+        tiling_processor.execute("Auto-Patching")
+        s.outputs = receiver.intersection_count
+
+    if receiver.truncated:
+        with span("border crossings", function="create_patch_tiled") as s:
+            crossings = complete_crossings(cell, electrode_layer_index, grid_layer_index, receiver.truncated, hierarchical)
+            receiver.patches += [patch_box(crossing.center(), patch_size_dbu) for crossing in crossings]
+            receiver.intersection_count += len(crossings)
+            s.inputs = len(receiver.truncated)
+            s.outputs = len(crossings)
+        log(f"{len(receiver.truncated)} intersection(s) reached the tile border of {tile_border:g} um "
+            f"and were computed without tiles.")
+
+    # Insert the patches collected from all tiles
+    if receiver.intersection_count == 0:
+        log("Warning: No intersections found between the electrode layer and the grid layer.")
+    with span("insertion", function="create_patch_tiled") as s:
+        s.inputs = len(receiver.patches)
+        s.outputs = insert_patches(cell, patch_layer_index, receiver.patches, merge_patches)
+
+    log(f"Patches created on layer {layer_info(patch_layer, patch_layer_datatype)}.")
+
+    return
+
+
+
+def lattice_axes(dbu, area_size, field_size, x_left, y_bottom):
+    """
+    The writing-field lattice in dbu as two axes (start, pitch, count, length) for x and y.
+    `area_size` and `field_size` (um) are a number for a square or an (x, y) pair.
+    All values are rounded to dbu first, so the number of fields per axis is exact.
+    """
+    area_x, area_y = area_size if isinstance(area_size, (tuple, list)) else (area_size, area_size)
+    field_x, field_y = field_size if isinstance(field_size, (tuple, list)) else (field_size, field_size)
+    axes = []
+    for start, area, field in ((x_left, area_x, field_x), (y_bottom, area_y, field_y)):
+        length = round(area / dbu)
+        pitch = round(field / dbu)
+        if pitch <= 0:
+            raise ValueError("The field size must be at least one dbu.")
+        axes.append((round(start / dbu), pitch, length // pitch, length))
+    return axes
+
 
-def create_grid(layout, cell, grid_layer, area_size, field_size, grid_line_width, x_left, y_bottom, datatype=0):
+def lattice_positions(start, pitch, first, last):
+    """
+    The coordinates start + i * pitch for i = first ... last - 1, as a list of ints.
+    """
+    if numpy is None:
+        return list(range(start + first * pitch, start + last * pitch, pitch))
+    return (numpy.arange(first, last, dtype=numpy.int64) * pitch + start).tolist()
+
+
+def lattice_lines(x_axis, y_axis, grid_line_width_dbu):
+    """
+    Boxes of the grid lines between the writing fields of a lattice (see `lattice_axes`),
+    the outer boundary of the area is not a stitch line.
+    """
+    x_start, x_pitch, x_count, width = x_axis
+    y_start, y_pitch, y_count, height = y_axis
+    half_width = grid_line_width_dbu // 2
+    boxes = [pya.Box(x - half_width, y_start, x + half_width, y_start + height)
+             for x in lattice_positions(x_start, x_pitch, 1, x_count)]
+    boxes += [pya.Box(x_start, y - half_width, x_start + width, y + half_width)
+              for y in lattice_positions(y_start, y_pitch, 1, y_count)]
+    return boxes
+
+
+def lattice_fields(x_axis, y_axis):
+    """
+    Boxes of all writing fields of a lattice (see `lattice_axes`), row by row from the lower left.
+    """
+    x_start, x_pitch, x_count, _ = x_axis
+    y_start, y_pitch, y_count, _ = y_axis
+    xs = lattice_positions(x_start, x_pitch, 0, x_count)
+    return [pya.Box(x, y, x + x_pitch, y + y_pitch) for y in lattice_positions(y_start, y_pitch, 0, y_count) for x in xs]
+
+
+def create_grid(layout, cell, grid_layer, area_size, field_size, grid_line_width, x_left, y_bottom, datatype=0,
+                output="lines"):
     """
     Create a grid of rectangles in the specified layout and layer.
     The grid is the boundary of writing fields, the whole exposure area size is area_size^2, 
     divided into writing fields of size field_size^2. The left-bottom coordinate of the area is (x_left, y_bottom).
+    For rectangular areas or fields, `area_size` and `field_size` can be (x, y) pairs.
+    `output` selects what is drawn: "lines" (the grid lines between the fields), "outlines" 
+    (one box per field, e.g. as input of `create_grid_from_shapes`) or "cells" (one field cell 
+    placed by a single array instance, compact for very fine lattices).
     """
     # turn um into dbu (standard unit in KLayout)
     dbu = layout.dbu
-    area_size_dbu = int(area_size / dbu)
-    field_size_dbu = int(field_size / dbu)
-    grid_line_width_dbu = int(grid_line_width / dbu)
-    x_left_dbu = int(x_left / dbu)
-    y_bottom_dbu = int(y_bottom / dbu)
+    x_axis, y_axis = lattice_axes(dbu, area_size, field_size, x_left, y_bottom)
+    grid_line_width_dbu = round(grid_line_width / dbu)
 
     # find or create the grid layer
-    grid_layer_index = find_or_create_layer(layout, pya.LayerInfo(grid_layer, datatype))
+    grid_layer_index = find_or_create_layer(layout, layer_info(grid_layer, datatype))
 
-    # calculate the number of lines needed
-    num_lines = int(area_size / field_size) - 1
+    with span("insertion", function="create_grid", output=output) as s:
+        if output == "lines":
+            # all line coordinates at once, inserted in one bulk call
+            boxes = lattice_lines(x_axis, y_axis, grid_line_width_dbu)
+            cell.shapes(grid_layer_index).insert(pya.Region(boxes))
+            s.outputs = len(boxes)
+        elif output == "outlines":
+            boxes = lattice_fields(x_axis, y_axis)
+            cell.shapes(grid_layer_index).insert(pya.Region(boxes))
+            s.outputs = len(boxes)
+        elif output == "cells":
+            x_start, x_pitch, x_count, _ = x_axis
+            y_start, y_pitch, y_count, _ = y_axis
+            field_cell = layout.create_cell(f"WRITING_FIELD_{x_pitch * dbu:g}x{y_pitch * dbu:g}")
+            field_cell.shapes(grid_layer_index).insert(pya.Box(0, 0, x_pitch, y_pitch))
+            if x_count > 0 and y_count > 0:
+                cell.insert(pya.CellInstArray(field_cell.cell_index(), pya.Trans(pya.Vector(x_start, y_start)),
+                                              pya.Vector(x_pitch, 0), pya.Vector(0, y_pitch), x_count, y_count))
+            s.outputs = x_count * y_count
+        else:
+            raise ValueError(f"Unknown grid output '{output}'.")
 
-    for i in range(1, num_lines + 1):
-        # create vertical lines
-        x_pos = i * field_size_dbu + x_left_dbu
-        p1 = pya.Point(x_pos - grid_line_width_dbu // 2, y_bottom_dbu)
-        p2 = pya.Point(x_pos + grid_line_width_dbu // 2, area_size_dbu + y_bottom_dbu)
-        cell.shapes(grid_layer_index).insert(pya.Box(p1, p2))
+    log(f"Grid created on layer: {layer_info(grid_layer, datatype)}")
+    
+    return
 
-        # create horizontal lines
-        y_pos = i * field_size_dbu + y_bottom_dbu
-        p1 = pya.Point(x_left_dbu, y_pos - grid_line_width_dbu // 2)
-        p2 = pya.Point(area_size_dbu + x_left_dbu, y_pos + grid_line_width_dbu // 2)
-        cell.shapes(grid_layer_index).insert(pya.Box(p1, p2))
 
-    print("Grid created on layer: ", pya.LayerInfo(grid_layer, datatype))
-    
+
+def cover_intervals(edges, position):
+    """
+    Intervals covered by a polygon on the line a = `position`, given the polygon edges 
+    as (a1, b1, a2, b2) tuples. Returns a sorted list of (b1, b2).
+    """
+    cuts = []
+    for a1, b1, a2, b2 in edges:
+        if min(a1, a2) <= position < max(a1, a2):
+            cuts.append(b1 + (position - a1) * (b2 - b1) / (a2 - a1))
+    cuts.sort()
+    return [(cuts[k], cuts[k + 1]) for k in range(0, len(cuts) - 1, 2)]
+
+
+def line_bands(edges, centers, half_width):
+    """
+    The polygon edges ((a1, b1, a2, b2) tuples) crossing the band center-half_width < a <
+    center+half_width of every line, for lines at ascending `centers`. The edges are sorted
+    once and swept along the lines, so an edge is only looked at by the bands it crosses.
+    Yields (center, band edges).
+    """
+    edges = sorted((e for e in edges if e[0] != e[2]), key=lambda e: min(e[0], e[2]))
+    active = []
+    k = 0
+    for center in centers:
+        lo, hi = center - half_width, center + half_width
+        while k < len(edges) and min(edges[k][0], edges[k][2]) < hi:
+            active.append(edges[k])
+            k += 1
+        active = [e for e in active if max(e[0], e[2]) > lo]
+        yield center, active
+
+
+def band_pieces(band_edges, center, half_width, b_min, b_max):
+    """
+    Pieces of a Manhattan polygon inside the band center-half_width < a < center+half_width,
+    b_min < b < b_max (a grid line), given the polygon edges crossing the band (see `line_bands`).
+    The band is cut into slabs at the polygon vertices, inside a slab the covered intervals
+    don't change.
+    Returns a list of [a1, b1, a2, b2] rectangles.
+    """
+    lo, hi = center - half_width, center + half_width
+    vertices = {a for e in band_edges for a in (e[0], e[2]) if lo < a < hi}
+    events = sorted({lo, hi} | vertices)
+    pieces = []
+    for a1, a2 in zip(events, events[1:]):
+        for b1, b2 in cover_intervals(band_edges, (a1 + a2) / 2):
+            b1, b2 = max(b1, b_min), min(b2, b_max)
+            if b1 < b2:
+                pieces.append([a1, b1, a2, b2])
+    return pieces
+
+
+def find_lattice_crossings(region, x_axis, y_axis, grid_line_width_dbu):
+    """
+    Compute the crossings between the shapes of `region` and the grid lines of a regular lattice
+    (as drawn by `create_grid`, axes from `lattice_axes`) arithmetically from the line positions,
+    without creating the grid. Returns one pya.Box per crossing: the bounding box of a polygon
+    of `region & grid`, i.e. touching pieces (e.g. at a line junction) are combined.
+    Only the shapes near a line are looked at, one by one and unmerged: the crossing
+    pieces of Manhattan shapes are computed from their edges, the other shapes are intersected
+    with the lines by a boolean. Merging the small pieces instead of the shapes gives the same
+    crossings as the boolean path for Manhattan shapes. Where a non-Manhattan shape overlaps
+    another shape, the boolean path rounds their intersection points when merging, so a crossing
+    there can differ by 1 dbu (and its patch move by 1 dbu); merging these shapes first would
+    make the fast path about as slow as the boolean.
+    """
+    x_left_dbu, x_pitch, x_count, width = x_axis
+    y_bottom_dbu, y_pitch, y_count, height = y_axis
+    half_width = grid_line_width_dbu // 2
+
+    shape_region = region.dup()
+    shape_region.merged_semantics = False
+    piece_region = pya.Region()
+    other_region = pya.Region()
+    for polygon in shape_region.each():
+        bbox = polygon.bbox()
+        # lines whose band overlaps the polygon bbox
+        i_x = range(max(1, (bbox.left - half_width - x_left_dbu) // x_pitch + 1),
+                    min(x_count - 1, -((x_left_dbu - bbox.right - half_width) // x_pitch) - 1) + 1)
+        i_y = range(max(1, (bbox.bottom - half_width - y_bottom_dbu) // y_pitch + 1),
+                    min(y_count - 1, -((y_bottom_dbu - bbox.top - half_width) // y_pitch) - 1) + 1)
+        if not i_x and not i_y:
+            continue
+        if not polygon.is_rectilinear():
+            other_region.insert(polygon)
+            continue
+
+        # crossing pieces of this polygon as [left, bottom, right, top]
+        pieces = []
+        if polygon.is_box():
+            # a box crosses a line in one rectangle, no need to scan the edges
+            for i in i_x:
+                x = x_left_dbu + i * x_pitch
+                pieces.append([max(bbox.left, x - half_width), max(bbox.bottom, y_bottom_dbu),
+                               min(bbox.right, x + half_width), min(bbox.top, y_bottom_dbu + height)])
+            for i in i_y:
+                y = y_bottom_dbu + i * y_pitch
+                pieces.append([max(bbox.left, x_left_dbu), max(bbox.bottom, y - half_width),
+                               min(bbox.right, x_left_dbu + width), min(bbox.top, y + half_width)])
+        else:
+            edges = [(e.p1.x, e.p1.y, e.p2.x, e.p2.y) for e in polygon.each_edge()]
+            centers = [x_left_dbu + i * x_pitch for i in i_x]
+            for x, band_edges in line_bands(edges, centers, half_width):
+                pieces += band_pieces(band_edges, x, half_width, y_bottom_dbu, y_bottom_dbu + height)
+            edges = [(y1, x1, y2, x2) for x1, y1, x2, y2 in edges]
+            centers = [y_bottom_dbu + i * y_pitch for i in i_y]
+            for y, band_edges in line_bands(edges, centers, half_width):
+                for y1, x1, y2, x2 in band_pieces(band_edges, y, half_width, x_left_dbu, x_left_dbu + width):
+                    pieces.append([x1, y1, x2, y2])
+        for left, bottom, right, top in pieces:
+            if left < right and bottom < top:
+                piece_region.insert(pya.Box(round(left), round(bottom), round(right), round(top)))
+
+    if not other_region.is_empty():
+        piece_region += other_region & pya.Region(lattice_lines(x_axis, y_axis, grid_line_width_dbu))
+    # combine the pieces of overlapping shapes and touching pieces, like the boolean does
+    return [polygon.bbox() for polygon in piece_region.merged().each()]
+
+
+def create_patch_from_lattice(layout, cell, electrode_layer, patch_layer, patch_size,
+                              area_size, field_size, grid_line_width, x_left, y_bottom,
+                              electrode_layer_datatype=0, patch_layer_datatype=0, merge_patches=False):
+    """
+    Fast path of `create_grid` + `create_patch` for a regular lattice of writing fields:
+    the crossings of the electrodes with the field boundaries are computed from the known line 
+    positions (see `find_lattice_crossings`), so no grid layer is needed and Manhattan electrodes
+    need no boolean.
+    The lattice parameters are the same as for `create_grid`.
+    """
+    # turn um into dbu (standard unit in KLayout)
+    dbu = layout.dbu
+    x_axis, y_axis = lattice_axes(dbu, area_size, field_size, x_left, y_bottom)
+    grid_line_width_dbu = round(grid_line_width / dbu)
+    patch_size_dbu = int(patch_size / dbu)
+
+    # Get layer indices
+    electrode_layer_index = find_or_create_layer(layout, layer_info(electrode_layer, electrode_layer_datatype))
+    patch_layer_index = find_or_create_layer(layout, layer_info(patch_layer, patch_layer_datatype))
+
+    with span("region building", function="create_patch_from_lattice") as s:
+        electrode_region = pya.Region(cell.shapes(electrode_layer_index))
+        s.outputs = electrode_region.count()
+
+    with span("crossing scan", function="create_patch_from_lattice") as s:
+        crossings = find_lattice_crossings(electrode_region, x_axis, y_axis, grid_line_width_dbu)
+        s.inputs = electrode_region.count()
+        s.outputs = len(crossings)
+
+    # Create patches at the center of crossings
+    if not crossings:
+        log("Warning: No crossings found between the electrode layer and the writing field boundaries.")
+    with span("patch generation", function="create_patch_from_lattice") as s:
+        patches = [patch_box(crossing.center(), patch_size_dbu) for crossing in crossings]
+        s.inputs = len(crossings)
+        s.outputs = len(patches)
+
+    with span("insertion", function="create_patch_from_lattice") as s:
+        s.inputs = len(patches)
+        s.outputs = insert_patches(cell, patch_layer_index, patches, merge_patches)
+
+    log(f"Patches created on layer {layer_info(patch_layer, patch_layer_datatype)}.")
+
+    return
+
+
+def field_fingerprints(cell, field_layer_index, electrode_layer_index, margin_dbu):
+    """
+    Fingerprint of the electrode shapes around every writing field: {field: sha1 hex digest}.
+    A field is identified by its polygon string; the electrodes touching the field bbox enlarged
+    by `margin_dbu` are hashed, so changes on a field boundary show up in both fields.
+    """
+    electrode_shapes = cell.shapes(electrode_layer_index)
+    fingerprints = {}
+    for field_shape in cell.shapes(field_layer_index).each():
+        field_polygon = field_shape.polygon
+        if field_polygon is None:
+            continue
+        window = field_polygon.bbox().enlarged(margin_dbu, margin_dbu)
+        content = sorted(str(shape.polygon) for shape in electrode_shapes.each_touching(window) if shape.polygon is not None)
+        fingerprints[str(field_polygon)] = hashlib.sha1("\n".join(content).encode()).hexdigest()
+    return fingerprints
+
+
+def update_patches(layout, cell, shape_layer, electrode_layer, grid_layer, patch_layer, grid_line_width, patch_size,
+                   shape_layer_datatype=0, electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                   merge_patches=False):
+    """
+    Incremental version of `create_grid_from_shapes` + `create_patch`: keeps a fingerprint of the
+    electrodes of every writing field (in the cell meta info, saved with the layout) and on a re-run
+    only removes and regenerates the patches of the fields whose electrodes changed.
+    Grid and patch layers are cleared and rebuilt completely on the first run, when the writing
+    fields change or when the parameters change.
+    """
+    # Get the database unit (dbu) for unit conversion
+    dbu = layout.dbu
+    grid_line_width_dbu = int(grid_line_width / dbu)
+    patch_size_dbu = int(patch_size / dbu)
+    # crossings on a field boundary belong to the fields on both sides of the line
+    margin_dbu = grid_line_width_dbu // 2 + 1
+
+    # Get layer indices
+    shape_layer_index = find_or_create_layer(layout, layer_info(shape_layer, shape_layer_datatype))
+    electrode_layer_index = find_or_create_layer(layout, layer_info(electrode_layer, electrode_layer_datatype))
+    grid_layer_index = find_or_create_layer(layout, layer_info(grid_layer, grid_layer_datatype))
+    patch_layer_index = find_or_create_layer(layout, layer_info(patch_layer, patch_layer_datatype))
+
+    with span("fingerprinting", function="update_patches") as s:
+        fingerprints = field_fingerprints(cell, shape_layer_index, electrode_layer_index, margin_dbu)
+        s.outputs = len(fingerprints)
+    parameters = [str(layer_info(shape_layer, shape_layer_datatype)), str(layer_info(electrode_layer, electrode_layer_datatype)),
+                  str(layer_info(grid_layer, grid_layer_datatype)), str(layer_info(patch_layer, patch_layer_datatype)),
+                  grid_line_width_dbu, patch_size_dbu, merge_patches]
+
+    meta_name = "auto_patching.fingerprints"
+    previous = cell.meta_info_value(meta_name)
+    previous = json.loads(previous) if previous else None
+
+    if previous is None or previous["parameters"] != parameters or set(previous["fields"]) != set(fingerprints):
+        # start from scratch, removing the output of earlier runs instead of adding duplicates
+        log("Full update: no previous run, or writing fields or parameters changed.")
+        cell.shapes(grid_layer_index).clear()
+        cell.shapes(patch_layer_index).clear()
+        create_grid_from_shapes(layout, cell, shape_layer, grid_layer, grid_line_width,
+                                shape_layer_datatype, grid_layer_datatype)
+        create_patch(layout, cell, electrode_layer, grid_layer, patch_layer, patch_size,
+                     electrode_layer_datatype, grid_layer_datatype, patch_layer_datatype,
+                     merge_patches=merge_patches)
+    else:
+        changed = [pya.Polygon.from_s(field) for field, fingerprint in fingerprints.items()
+                   if previous["fields"][field] != fingerprint]
+        log(f"Incremental update: {len(changed)} of {len(fingerprints)} writing fields changed.")
+        if changed:
+            dirty_boxes = [field.bbox().enlarged(margin_dbu, margin_dbu) for field in changed]
+            def is_dirty(point):
+                return any(box.contains(point) for box in dirty_boxes)
+
+            # remove the patches owned by the changed fields (by their center)
+            with span("patch removal", function="update_patches") as s:
+                patch_shapes = cell.shapes(patch_layer_index)
+                s.inputs = patch_shapes.size()
+                if layout.is_editable():
+                    stale = {}
+                    for box in dirty_boxes:
+                        for shape in patch_shapes.each_touching(box):
+                            if is_dirty(shape.bbox().center()):
+                                stale[str(shape)] = shape
+                    for shape in stale.values():
+                        patch_shapes.erase(shape)
+                else:
+                    # shapes can't be erased in viewer mode, rebuild the layer instead
+                    kept = [shape.polygon for shape in patch_shapes.each() if not is_dirty(shape.bbox().center())]
+                    patch_shapes.clear()
+                    patch_shapes.insert(pya.Region(kept))
+                s.outputs = patch_shapes.size()
+
+            # local grid and electrodes around the changed fields, like the fingerprints and the
+            # full update only from the cell itself
+            with span("region building", function="update_patches") as s:
+                field_region = pya.Region()
+                electrode_region = pya.Region()
+                for box in dirty_boxes:
+                    # fields next to a changed one contribute the grid lines on its boundary
+                    field_region += touching_region(cell, shape_layer_index, box)
+                    electrode_region += touching_region(cell, electrode_layer_index, box.enlarged(patch_size_dbu, patch_size_dbu))
+                field_region = pya.Region(list(dict.fromkeys(field_region.each()))) # fields touching several boxes
+                grid_region, _ = grid_from_shapes(field_region, grid_line_width_dbu)
+                s.outputs = electrode_region.count() + grid_region.count()
+
+            with span("boolean", function="update_patches") as s:
+                intersection_region = electrode_region & grid_region
+                s.inputs = electrode_region.count() + grid_region.count()
+                s.outputs = intersection_region.count()
+
+            with span("patch generation", function="update_patches") as s:
+                patches = [patch_box(polygon.bbox().center(), patch_size_dbu) for polygon in intersection_region.each()
+                           if is_dirty(polygon.bbox().center())]
+                s.inputs = intersection_region.count()
+                s.outputs = len(patches)
+
+            with span("insertion", function="update_patches") as s:
+                s.inputs = len(patches)
+                s.outputs = insert_patches(cell, patch_layer_index, patches, merge_patches)
+
+    cell.add_meta_info(pya.LayoutMetaInfo(meta_name, json.dumps({"parameters": parameters, "fields": fingerprints}), 
+                                          "fingerprints of the last Auto-Patching run", True))
+    log(f"Patches updated on layer {layer_info(patch_layer, patch_layer_datatype)}.")
+
     return
 
+
+def verify_patches(layout, cell, electrode_layer, grid_layer, patch_layer, patch_size,
+                   electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                   hierarchical=False, threads=None, min_width=None, session=None):
+    """
+    Check the output of `create_patch`: crossings of electrodes and grid without a patch
+    ("missing patch"), parts of patched crossings outside their patches ("uncovered crossing",
+    e.g. crossings wider than `patch_size`) and patches narrower than `min_width` (um,
+    default: `patch_size`; twice the margin for adaptive patches) within `min_width` of a
+    crossing ("narrow patch"; the cut ends of adaptive patches are not stitch-relevant).
+    The checks run in deep mode on `threads` threads (default: all cores), with
+    `hierarchical=True` on the whole cell tree, otherwise on the shapes of `cell` itself.
+    With a `session` (a LayoutSession) the merged layers are taken from it instead, so
+    the electrodes merged for `create_patch` are not merged again; `threads` is then the
+    one of the session.
+    Returns a pya.ReportDatabase, which can be saved as .lyrdb and browsed in KLayout.
+    """
+    # Get the database unit (dbu) for unit conversion
+    dbu = layout.dbu
+    min_width_dbu = int((patch_size if min_width is None else min_width) / dbu)
+
+    dss = pya.DeepShapeStore()
+    dss.threads = threads if threads is not None else (os.cpu_count() or 1)
+    def input_region(layer, datatype):
+        layer_index = layout.find_layer(layer_info(layer, datatype))
+        if layer_index is None:
+            return pya.Region()
+        if session is not None:
+            return session.region(layer_index, cell, hierarchical)
+        iterator = cell.begin_shapes_rec(layer_index)
+        if not hierarchical:
+            iterator.max_depth = 0
+        return pya.Region(iterator, dss)
+
+    with span("region building", function="verify_patches") as s:
+        electrode_region = input_region(electrode_layer, electrode_layer_datatype)
+        grid_region = input_region(grid_layer, grid_layer_datatype)
+        patch_region = input_region(patch_layer, patch_layer_datatype)
+        s.outputs = electrode_region.count() + grid_region.count() + patch_region.count()
+
+    with span("boolean", function="verify_patches") as s:
+        crossing_region = electrode_region & grid_region
+        missing_region = crossing_region.not_interacting(patch_region)
+        uncovered_region = crossing_region.interacting(patch_region) - patch_region
+        s.inputs = crossing_region.count() + patch_region.count()
+        s.outputs = missing_region.count() + uncovered_region.count()
+
+    with span("width check", function="verify_patches") as s:
+        narrow_pairs = patch_region.width_check(min_width_dbu).interacting(crossing_region.sized(min_width_dbu))
+        s.inputs = patch_region.count()
+        s.outputs = narrow_pairs.count()
+
+    report = pya.ReportDatabase("Auto-Patching verification")
+    report.top_cell_name = cell.name
+    report_cell = report.create_cell(cell.name)
+    trans = pya.CplxTrans(dbu)
+    for name, description, shapes in (
+            ("missing patch", "Crossing of electrode and grid without a patch", missing_region),
+            ("uncovered crossing", "Part of a patched crossing outside of the patches", uncovered_region),
+            ("narrow patch", f"Patch narrower than {min_width_dbu * dbu:g} um", narrow_pairs)):
+        category = report.create_category(name)
+        category.description = description
+        report.create_items(report_cell.rdb_id(), category.rdb_id(), trans, shapes)
+
+    if report.num_items() == 0:
+        log("Verification passed: every crossing is covered by a patch.")
+    else:
+        log(f"Verification found {missing_region.count()} missing patch(es), {uncovered_region.count()} uncovered "
+            f"crossing part(s) and {narrow_pairs.count()} narrow patch location(s).")
+
+    return report
+
+
+def complete_crossings(cell, electrode_layer_index, grid_layer_index, boxes, hierarchical=False):
+    """
+    Bounding boxes of the complete intersections of electrodes and grid (of `cell`, with
+    `hierarchical` also of its children) overlapping any of `boxes`. Only the shapes touching
+    windows around the boxes are read; the windows of the intersections still reaching their
+    border are grown and read again.
+    """
+    crossings = set()
+    seeds = pya.Region()
+    for box in boxes:
+        seeds.insert(box)
+    windows = seeds.sized(1)
+    while not seeds.is_empty():
+        electrode_region = pya.Region(shape_iterator(cell, electrode_layer_index, hierarchical, windows))
+        grid_region = pya.Region(shape_iterator(cell, grid_layer_index, hierarchical, windows))
+        crossing_region = (electrode_region & grid_region).interacting(seeds)
+        interior = windows.merged().sized(-1)
+        crossings.update(polygon.bbox() for polygon in crossing_region.inside(interior).each())
+        seeds = crossing_region.not_inside(interior)
+        windows = pya.Region()
+        for polygon in seeds.each():
+            box = polygon.bbox()
+            windows.insert(box.enlarged(box.width() // 2 + 1, box.height() // 2 + 1))
+    return list(crossings)
+
+
+def shape_iterator(cell, layer_index, hierarchical, region=None):
+    """
+    Iterator over the shapes of `cell` (with `hierarchical` also of its children), only
+    those touching `region` (a Region) if given.
+    """
+    if region is None:
+        iterator = cell.begin_shapes_rec(layer_index)
+    else:
+        iterator = pya.RecursiveShapeIterator(cell.layout(), cell, layer_index, region, False)
+    if not hierarchical:
+        iterator.max_depth = 0
+    return iterator
+
+
+def touching_region(cell, layer_index, box):
+    """
+    Region of the shapes of `cell` itself (not of its children) touching `box`.
+    """
+    iterator = cell.begin_shapes_rec_touching(layer_index, box)
+    iterator.max_depth = 0
+    return pya.Region(iterator)
+
+
+def window_interior(window, box):
+    """
+    True if `box` lies inside `window` without touching its border.
+    """
+    return (box.left > window.left and box.right < window.right and
+            box.bottom > window.bottom and box.top < window.top)
+
+
+class ChunkedPatchingJob:
+    """
+    `create_grid_from_shapes` + `create_patch` split into small steps, for running from an
+    event loop with progress reporting and cancellation: the first step builds the grid, every
+    further step patches `fields_per_chunk` writing fields. As in the flat mode of these
+    functions only the shapes of `cell` itself are used. Nothing is written to the layout
+    until `commit()`, so a cancelled job is simply dropped.
+    """
+    def __init__(self, layout, cell, shape_layer, electrode_layer, grid_layer, patch_layer, grid_line_width, patch_size,
+                 shape_layer_datatype=0, electrode_layer_datatype=0, grid_layer_datatype=0, patch_layer_datatype=0,
+                 merge_patches=False, fields_per_chunk=1):
+        self.layout = layout
+        self.cell = cell
+        self.grid_layer_info = layer_info(grid_layer, grid_layer_datatype)
+        self.patch_layer_info = layer_info(patch_layer, patch_layer_datatype)
+        self.merge_patches = merge_patches
+        self.fields_per_chunk = max(1, fields_per_chunk)
+
+        # Get the database unit (dbu) for unit conversion
+        dbu = layout.dbu
+        self.grid_line_width_dbu = int(grid_line_width / dbu)
+        self.patch_size_dbu = int(patch_size / dbu)
+
+        # input layers must exist, output layers are only created on commit
+        self.shape_layer_index = layout.find_layer(layer_info(shape_layer, shape_layer_datatype))
+        self.electrode_layer_index = layout.find_layer(layer_info(electrode_layer, electrode_layer_datatype))
+        if self.shape_layer_index is None or self.electrode_layer_index is None:
+            raise Exception("Writing field layer or electrode layer not found.")
+
+        self.fields = [shape.polygon for shape in cell.shapes(self.shape_layer_index).each() if shape.polygon is not None]
+        self.grid_region = None
+        self.patches = []
+        self.fields_done = 0
+        self.shapes_done = 0
+        self.seconds = 0.0
+
+    @property
+    def total(self):
+        """
+        Number of work units: one for the grid plus one per writing field.
+        """
+        return len(self.fields) + 1
+
+    @property
+    def done(self):
+        return (self.grid_region is not None) + self.fields_done
+
+    def finished(self):
+        return self.done >= self.total
+
+    def step(self):
+        """
+        Process the next chunk. Returns False when there is nothing left to do.
+        """
+        if self.finished():
+            return False
+        t_start = time.perf_counter()
+        if self.grid_region is None:
+            self.grid_region, _ = grid_from_shapes(pya.Region(self.fields), self.grid_line_width_dbu)
+            self.shapes_done += len(self.fields)
+        else:
+            chunk = self.fields[self.fields_done:self.fields_done + self.fields_per_chunk]
+            # a crossing on the boundary of a chunk field is owned by it, the duplicate
+            # from the neighbouring field is dropped on insertion
+            half_width = self.grid_line_width_dbu // 2
+            owned = [field.bbox().enlarged(half_width, half_width) for field in chunk]
+            window = pya.Box()
+            for box in owned:
+                window += box
+            window = window.enlarged(self.patch_size_dbu, self.patch_size_dbu)
+
+            # an intersection reaching the window border may continue outside of it, so the
+            # window grows until the intersections which may be owned by the chunk are complete
+            while True:
+                electrode_region, intersections = self.local_intersections(window)
+                incomplete = [polygon.bbox() for polygon in intersections.each()
+                              if not window_interior(window, polygon.bbox()) and any(box.touches(polygon.bbox()) for box in owned)]
+                if not incomplete:
+                    break
+                # at least double the window, long electrode clusters would otherwise take
+                # many small steps
+                for box in incomplete:
+                    window += box
+                window = window.enlarged(window.width() // 2, window.height() // 2)
+            for polygon in intersections.each():
+                center = polygon.bbox().center()
+                if any(box.contains(center) for box in owned):
+                    self.patches.append(patch_box(center, self.patch_size_dbu))
+            self.fields_done += len(chunk)
+            self.shapes_done += electrode_region.count()
+        self.seconds += time.perf_counter() - t_start
+        return not self.finished()
+
+    def local_intersections(self, window):
+        """
+        Electrodes touching `window` and their intersections with the grid lines of the
+        writing fields around it.
+        """
+        margin = self.grid_line_width_dbu
+        local_fields = touching_region(self.cell, self.shape_layer_index, window.enlarged(margin, margin))
+        local_grid, _ = grid_from_shapes(local_fields, self.grid_line_width_dbu)
+        electrode_region = touching_region(self.cell, self.electrode_layer_index, window)
+        return electrode_region, electrode_region & local_grid
+
+    def rate(self):
+        """
+        Input shapes processed per second so far.
+        """
+        return self.shapes_done / self.seconds if self.seconds > 0 else 0.0
+
+    def eta(self):
+        """
+        Estimated remaining time in seconds, from the average time per field so far.
+        """
+        if self.fields_done == 0:
+            return None
+        return self.seconds / self.done * (self.total - self.done)
+
+    def commit(self):
+        """
+        Insert grid and patches into the layout (call once, after the last step).
+        """
+        grid_layer_index = find_or_create_layer(self.layout, self.grid_layer_info)
+        patch_layer_index = find_or_create_layer(self.layout, self.patch_layer_info)
+        with span("insertion", function="ChunkedPatchingJob") as s:
+            self.cell.shapes(grid_layer_index).insert(self.grid_region)
+            s.inputs = len(self.patches)
+            s.outputs = insert_patches(self.cell, patch_layer_index, self.patches, self.merge_patches)
+        if not self.patches:
+            log("Warning: No intersections found between the electrode layer and the grid layer.")
+        log(f"Patches created on layer {self.patch_layer_info} in {self.total - 1} writing fields, {self.seconds:.3f} s.")
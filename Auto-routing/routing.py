@@ -0,0 +1,479 @@
+# Route contact leads: connect pairs of pads on one layer with Manhattan or 45 degree paths
+# of a given width, keeping a minimum spacing to existing shapes and to each other.
+#
+# The routes are searched with A* on a grid of pitch width + spacing. The obstacles are
+# rasterized lazily in tiles: a tile queries only the shapes overlapping it through the
+# spatial index of the layout, so a route only pays for the area around it. Nets whose
+# search windows don't overlap can't interact and are routed in parallel worker processes,
+# batch by batch; all routes are inserted with one bulk call at the end.
+#
+# usage example:
+#   python routing.py chip.gds --layer 5 --nets nets.csv --width 5 --spacing 5 \
+#       --directions 45 --output chip_routed.gds
+# with one net "x1, y1, x2, y2" (um) per line of nets.csv, each point inside a pad.
+
+# add parent directory to sys.path to import auto_klayout_toolkit.py
+import os
+import sys
+script_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(script_path)
+parent_dir = os.path.dirname(current_dir)
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+
+# -----------------------------------------------------------------------------
+import argparse
+import contextlib
+import heapq
+import math
+import multiprocessing
+import time
+
+import pya
+from auto_klayout_toolkit import find_or_create_layer, layer_info, log, span
+
+DIRECTIONS = ("manhattan", "45")
+
+# steps in the order of their angle, 45 degrees apart; Manhattan routing uses the even ones
+STEPS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+# occupancy bits of a grid point, it is free if none is set
+FREE = 0
+BLOCKED = 1
+ROUTED = 2
+PAD = 4
+
+FREE_TABLE = bytes([1] + [0] * 255) # maps the occupancy to 1 for free points
+
+# weight of the A* estimate: 1 gives the shortest routes, larger values expand fewer states
+HEURISTIC_WEIGHT = 1.5
+
+
+class ObstacleMap:
+    """
+    Occupancy of the routing grid: grid point (ix, iy) sits at (ix * pitch, iy * pitch) dbu
+    and is blocked if the square of `pitch` around it touches an obstacle sized by
+    `clearance`. Tiles of `tile_cells` x `tile_cells` points are rasterized on first use,
+    from the shapes of `layer_indexes` overlapping the tile. Shapes touching one of
+    `exempt_points` are pads: they are rasterized separately by `add_pad` and marked
+    with the PAD bit, which every net clears for its own pads. Routed paths are marked
+    in the tiles with the ROUTED bit.
+    """
+    def __init__(self, cell, layer_indexes, pitch, clearance, exempt_points, tile_cells=64):
+        self.cell = cell
+        self.layer_indexes = layer_indexes
+        self.pitch = pitch
+        self.clearance = clearance
+        self.exempt_region = pya.Region([pya.Box(point, point).enlarged(1, 1) for point in exempt_points])
+        self.tile_cells = tile_cells
+        self.tiles = {}
+        # pads as (owner, ix0, iy0, nx, ny, raster), and the pads overlapping each tile
+        self.pads = []
+        self.tile_pads = {}
+
+    def shapes(self, box):
+        """
+        Region of the individual (unmerged) shapes overlapping `box`, from the whole cell tree.
+        """
+        region = pya.Region()
+        region.merged_semantics = False
+        for layer_index in self.layer_indexes:
+            region.insert(self.cell.begin_shapes_rec_overlapping(layer_index, box))
+        return region
+
+    def rasterize(self, region, ix0, iy0, nx, ny):
+        """
+        Grid points of the nx x ny block starting at (ix0, iy0) touched by `region`, as a
+        bytearray of BLOCKED/FREE, row by row.
+        """
+        half = self.pitch // 2
+        origin = pya.Point(ix0 * self.pitch - half, iy0 * self.pitch - half)
+        step = pya.Vector(self.pitch, self.pitch)
+        raster = region.rasterize(origin, step, step, nx, ny)
+        return bytearray().join(bytes(map(bool, row)) for row in raster) # BLOCKED is 1, FREE 0
+
+    def add_pad(self, owner, point):
+        """
+        Rasterize the pad at `point` (the shapes touching it) for net `owner`.
+        Must be called before the tiles around it are used.
+        """
+        point_region = pya.Region(pya.Box(point, point).enlarged(1, 1))
+        pad_region = self.shapes(pya.Box(point, point)).interacting(point_region).sized(self.clearance)
+        if pad_region.is_empty():
+            return
+        box = pad_region.bbox()
+        ix0, iy0 = -(-box.left // self.pitch) - 1, -(-box.bottom // self.pitch) - 1
+        nx, ny = box.right // self.pitch - ix0 + 2, box.top // self.pitch - iy0 + 2
+        self.pads.append((owner, ix0, iy0, nx, ny, self.rasterize(pad_region, ix0, iy0, nx, ny)))
+        n = self.tile_cells
+        for ty in range(iy0 // n, (iy0 + ny - 1) // n + 1):
+            for tx in range(ix0 // n, (ix0 + nx - 1) // n + 1):
+                self.tile_pads.setdefault((tx, ty), []).append(len(self.pads) - 1)
+
+    def paint(self, target, tx0, ty0, tnx, tny, pad, value):
+        """
+        Set (value PAD) or clear (value 0) the PAD bit of the points of `pad` inside the
+        block `target` of tnx x tny points starting at (tx0, ty0).
+        """
+        _, px0, py0, pnx, pny, raster = pad
+        x0, x1 = max(px0, tx0), min(px0 + pnx, tx0 + tnx)
+        for iy in range(max(py0, ty0), min(py0 + pny, ty0 + tny)):
+            a = (iy - ty0) * tnx - tx0
+            b = (iy - py0) * pnx - px0
+            for ix in range(x0, x1):
+                if raster[b + ix]:
+                    target[a + ix] = (target[a + ix] & ~PAD) | value
+
+    def tile(self, tx, ty):
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            n = self.tile_cells
+            half = self.pitch // 2
+            box = pya.Box(tx * n * self.pitch - half, ty * n * self.pitch - half,
+                          (tx + 1) * n * self.pitch - half, (ty + 1) * n * self.pitch - half)
+            region = self.shapes(box.enlarged(self.clearance, self.clearance))
+            region = region.not_interacting(self.exempt_region).sized(self.clearance)
+            tile = self.tiles[(tx, ty)] = self.rasterize(region, tx * n, ty * n, n, n)
+            for index in self.tile_pads.get((tx, ty), []):
+                self.paint(tile, tx * n, ty * n, n, n, self.pads[index], PAD)
+        return tile
+
+    def window(self, ix0, iy0, ix1, iy1, owner=None):
+        """
+        Occupancy of the grid points ix0..ix1 x iy0..iy1 (inclusive) as a bytearray, row by
+        row, with the pads of net `owner` cleared.
+        """
+        n = self.tile_cells
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        rows = [bytearray() for _ in range(ny)]
+        for ty in range(iy0 // n, iy1 // n + 1):
+            y0, y1 = max(iy0 - ty * n, 0), min(iy1 - ty * n, n - 1)
+            for tx in range(ix0 // n, ix1 // n + 1):
+                x0, x1 = max(ix0 - tx * n, 0), min(ix1 - tx * n, n - 1)
+                tile = self.tile(tx, ty)
+                for y in range(y0, y1 + 1):
+                    rows[ty * n + y - iy0] += tile[y * n + x0:y * n + x1 + 1]
+        occupancy = bytearray().join(rows)
+
+        # clear the own pads, then restore the pads of other nets overlapping them
+        own = [pad for pad in self.pads if pad[0] == owner] if owner is not None else []
+        for pad in own:
+            self.paint(occupancy, ix0, iy0, nx, ny, pad, 0)
+        for pad in own:
+            _, px0, py0, pnx, pny, _ = pad
+            for other in self.pads:
+                if other[0] != owner and other[1] < px0 + pnx and px0 < other[1] + other[3] \
+                        and other[2] < py0 + pny and py0 < other[2] + other[4]:
+                    self.paint(occupancy, ix0, iy0, nx, ny, other, PAD)
+        return occupancy
+
+    def mark(self, points):
+        """
+        Mark grid points (ix, iy) as taken by a route.
+        """
+        n = self.tile_cells
+        for ix, iy in points:
+            tx, x = divmod(ix, n)
+            ty, y = divmod(iy, n)
+            self.tile(tx, ty)[y * n + x] |= ROUTED
+
+
+def search(task):
+    """
+    A* search of one route in a window of the grid (runs in worker processes).
+    `task` holds the window size, its occupancy, the start and goal point (window
+    coordinates), whether 45 degree steps are allowed and the cost of a 90 degree bend.
+    Turns sharper than 90 degrees are not allowed, diagonal steps must not cut a corner.
+    Every point keeps only the direction of its cheapest arrival, so bends are priced
+    approximately, but the search visits each point once. The estimate is weighted by
+    HEURISTIC_WEIGHT, which trades a little path length for far fewer expanded states.
+    Returns the list of window points from start to goal. Without a route it returns None if
+    the search reached the window border, so a larger window may help, and an empty list if
+    the start is enclosed.
+    """
+    width, height = task["size"]
+    diagonal = task["diagonal"]
+    bend_cost = task["bend_cost"]
+    # 1 for free points, with a blocked border around the window to save the bounds checks
+    row = width + 2
+    free = bytearray(row * (height + 2))
+    occupancy = task["occupancy"].translate(FREE_TABLE)
+    for y in range(height):
+        free[(y + 1) * row + 1:(y + 1) * row + 1 + width] = occupancy[y * width:(y + 1) * width]
+    start = (task["start"][1] + 1) * row + task["start"][0] + 1
+    goal_x, goal_y = task["goal"][0] + 1, task["goal"][1] + 1
+    goal = goal_y * row + goal_x
+
+    directions = range(8) if diagonal else range(0, 8, 2)
+    offsets = [dy * row + dx for dx, dy in STEPS]
+    # per direction of the last step (8: none): (step direction, offset, cost, corner offsets)
+    moves = []
+    for last in range(9):
+        moves.append([])
+        for d in directions:
+            turn = 0 if last == 8 else min((d - last) % 8, (last - d) % 8)
+            if turn > 2:
+                continue
+            dx, dy = STEPS[d]
+            corners = (dx, dy * row) if dx and dy else None
+            moves[last].append((d, offsets[d], (math.sqrt(2) if corners else 1.0) + bend_cost * turn / 2, corners))
+    diagonal_factor = math.sqrt(2) - 2
+
+    def estimate(node):
+        y, x = divmod(node, row)
+        dx, dy = abs(x - goal_x), abs(y - goal_y)
+        if diagonal:
+            return HEURISTIC_WEIGHT * (dx + dy + diagonal_factor * min(dx, dy))
+        return HEURISTIC_WEIGHT * (dx + dy)
+
+    # per point: cost, previous point and direction of the cheapest arrival (8 at the start)
+    cost = {start: 0.0}
+    previous = {start: None}
+    direction = {start: 8}
+    # ties of the estimate are broken by the remaining distance, so equally good paths
+    # don't all get expanded
+    h = estimate(start)
+    queue = [(h, h, 0.0, start)]
+    enclosed = True
+    while queue:
+        _, _, g, node = heapq.heappop(queue)
+        if g > cost[node]:
+            continue # reached again on a cheaper way since it was queued
+        if enclosed:
+            y, x = divmod(node, row)
+            enclosed = 1 < x < width and 1 < y < height
+        if node == goal:
+            path = []
+            while node is not None:
+                y, x = divmod(node, row)
+                path.append((x - 1, y - 1))
+                node = previous[node]
+            return path[::-1]
+        for d, offset, step_cost, corners in moves[direction[node]]:
+            next_node = node + offset
+            if not free[next_node]:
+                continue
+            if corners is not None and not (free[node + corners[0]] and free[node + corners[1]]):
+                continue
+            new_cost = g + step_cost
+            if new_cost < cost.get(next_node, math.inf):
+                cost[next_node] = new_cost
+                previous[next_node] = node
+                direction[next_node] = d
+                h = estimate(next_node)
+                heapq.heappush(queue, (new_cost + h, h, new_cost, next_node))
+    return [] if enclosed else None
+
+
+def corner_points(points):
+    """
+    The points of a grid path where its direction changes, including both ends.
+    """
+    corners = [points[0]]
+    for p0, p1, p2 in zip(points, points[1:], points[2:]):
+        if (p1[0] - p0[0], p1[1] - p0[1]) != (p2[0] - p1[0], p2[1] - p1[1]):
+            corners.append(p1)
+    if len(points) > 1:
+        corners.append(points[-1])
+    return corners
+
+
+def taken_points(points):
+    """
+    Grid points a path blocks for other routes: its own points, plus the corners cut by its
+    diagonal steps, so parallel diagonals keep the spacing of orthogonal tracks.
+    """
+    taken = set(points)
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if x0 != x1 and y0 != y1:
+            taken.add((x1, y0))
+            taken.add((x0, y1))
+    return taken
+
+
+def route_nets(layout, cell, layer, nets, width, spacing, layer_datatype=0, obstacle_layers=None,
+               directions="manhattan", pitch=None, bend_cost=1.0, processes=None, tile_cells=64):
+    """
+    Route `nets` (a list of ((x1, y1), (x2, y2)) pairs in um, each point inside a pad) on
+    `layer` of `cell` with paths of `width` (um), keeping `spacing` (um) to the shapes of
+    `obstacle_layers` (anything `layer_info` takes, e.g. "6/0" or (6, 0), default: `layer` itself,
+    including child cells) and to each other. The pads, i.e. the shapes touching the net
+    points, are not obstacles for their own net.
+    `directions` is "manhattan" or "45"; `pitch` (um) is the routing grid, at least and by
+    default `width` + `spacing`; `bend_cost` is the cost of a 90 degree bend in grid steps.
+    Nets with non-overlapping search windows are routed in parallel on `processes` worker
+    processes (default: all cores; use 1 inside KLayout), nets that don't fit their window
+    are retried with a larger one.
+    Returns a list with a pya.DPath per net, None for nets that couldn't be routed.
+    """
+    if directions not in DIRECTIONS:
+        raise ValueError(f"Unknown directions '{directions}'.")
+    # Get the database unit (dbu) for unit conversion
+    dbu = layout.dbu
+    width_dbu = int(width / dbu)
+    pitch_dbu = int((width + spacing if pitch is None else pitch) / dbu)
+    if pitch_dbu < width_dbu + int(spacing / dbu):
+        raise ValueError(f"The routing pitch must be at least width + spacing ({width + spacing} um).")
+    clearance_dbu = width_dbu // 2 + int(spacing / dbu)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    # Get layer indices
+    layer_index = find_or_create_layer(layout, layer_info(layer, layer_datatype))
+    if obstacle_layers is None:
+        obstacle_indexes = [layer_index]
+    else:
+        obstacle_indexes = [find_or_create_layer(layout, layer_info(obstacle)) for obstacle in obstacle_layers]
+
+    endpoints = [(pya.DPoint(*p1).to_itype(dbu), pya.DPoint(*p2).to_itype(dbu)) for p1, p2 in nets]
+    obstacles = ObstacleMap(cell, obstacle_indexes, pitch_dbu, clearance_dbu,
+                            [point for pair in endpoints for point in pair], tile_cells)
+
+    # the pads of every net are obstacles for the other nets only
+    with span("pad lookup", function="route_nets") as s:
+        for net, pair in enumerate(endpoints):
+            for point in pair:
+                obstacles.add_pad(net, point)
+        s.outputs = len(obstacles.pads)
+
+    # routing area: the cell and the nets with some room around them, in grid points
+    area = cell.bbox()
+    for pair in endpoints:
+        for point in pair:
+            area += point
+    area_x0, area_y0 = area.left // pitch_dbu - 8, area.bottom // pitch_dbu - 8
+    area_x1, area_y1 = -(-area.right // pitch_dbu) + 8, -(-area.top // pitch_dbu) + 8
+
+    grid_ends = [tuple((round(point.x / pitch_dbu), round(point.y / pitch_dbu)) for point in pair) for pair in endpoints]
+    margins = [max(8, (abs(a[0] - b[0]) + abs(a[1] - b[1])) // 4) for a, b in grid_ends]
+    paths = [None] * len(nets)
+
+    def window(net):
+        (ax, ay), (bx, by) = grid_ends[net]
+        margin = margins[net]
+        return (max(min(ax, bx) - margin, area_x0), max(min(ay, by) - margin, area_y0),
+                min(max(ax, bx) + margin, area_x1), min(max(ay, by) + margin, area_y1))
+
+    def task(net, box):
+        ix0, iy0, ix1, iy1 = box
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        occupancy = obstacles.window(ix0, iy0, ix1, iy1, owner=net)
+        ends = [(ix - ix0, iy - iy0) for ix, iy in grid_ends[net]]
+        for x, y in ends:
+            occupancy[y * nx + x] = FREE
+        return {"size": (nx, ny), "occupancy": occupancy, "start": ends[0], "goal": ends[1],
+                "diagonal": directions == "45", "bend_cost": bend_cost}
+
+    # short nets first, they have the fewest alternatives
+    pending = sorted(range(len(nets)), key=lambda net: margins[net])
+    failed = []
+    batches = 0
+    with span("search", function="route_nets", processes=processes) as s, \
+            (multiprocessing.Pool(processes) if processes > 1 else contextlib.nullcontext()) as pool:
+        while pending:
+            # a batch of nets whose windows don't overlap, so their routes are independent
+            batch, boxes, later = [], [], []
+            for net in pending:
+                box = window(net)
+                if any(box[0] <= other[2] and other[0] <= box[2] and box[1] <= other[3] and other[1] <= box[3]
+                       for other in boxes):
+                    later.append(net)
+                else:
+                    batch.append(net)
+                    boxes.append(box)
+            tasks = [task(net, box) for net, box in zip(batch, boxes)]
+            results = pool.map(search, tasks) if pool is not None and len(tasks) > 1 else [search(t) for t in tasks]
+            batches += 1
+
+            for net, box, result in zip(batch, boxes, results):
+                if result:
+                    points = [(ix + box[0], iy + box[1]) for ix, iy in result]
+                    obstacles.mark(taken_points(points))
+                    paths[net] = points
+                elif result is not None or box == (area_x0, area_y0, area_x1, area_y1):
+                    failed.append(net) # enclosed, or no route in the whole area
+                else:
+                    margins[net] *= 2
+                    later.append(net)
+            pending = later
+        s.inputs = len(nets)
+        s.outputs = len(nets) - len(failed)
+
+    with span("insertion", function="route_nets") as s:
+        routes = []
+        route_region = pya.Region()
+        for net, points in enumerate(paths):
+            if points is None:
+                routes.append(None)
+                continue
+            corners = [pya.Point(ix * pitch_dbu, iy * pitch_dbu) for ix, iy in corner_points(points)]
+            # connect the net points to the grid with an orthogonal step inside their pads
+            start, goal = endpoints[net]
+            corners = [start, pya.Point(corners[0].x, start.y)] + corners + [pya.Point(corners[-1].x, goal.y), goal]
+            path = pya.Path(corners, width_dbu)
+            route_region.insert(path.polygon())
+            routes.append(path.to_dtype(dbu))
+        cell.shapes(layer_index).insert(route_region)
+        s.outputs = route_region.count()
+
+    if failed:
+        log(f"Warning: {len(failed)} net(s) could not be routed: {sorted(failed)}.")
+    log(f"{len(nets) - len(failed)} of {len(nets)} net(s) routed in {batches} batch(es) "
+        f"on layer {layer_info(layer, layer_datatype)}.")
+    return routes
+
+
+def read_nets(path):
+    """
+    Nets from a text file with one "x1, y1, x2, y2" (um) per line; empty lines and lines
+    starting with # are skipped.
+    """
+    nets = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            x1, y1, x2, y2 = (float(value) for value in line.replace(",", " ").split())
+            nets.append(((x1, y1), (x2, y2)))
+    return nets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Route contact leads between pairs of pads.")
+    parser.add_argument("input", help="layout file")
+    parser.add_argument("--layer", required=True, help="routing layer, e.g. 5 or 5/0")
+    parser.add_argument("--nets", required=True, help="text file with one net 'x1, y1, x2, y2' (um) per line")
+    parser.add_argument("--width", type=float, required=True, help="lead width in um")
+    parser.add_argument("--spacing", type=float, required=True, help="minimum spacing in um")
+    parser.add_argument("--obstacle-layers", nargs="+", default=None, help="layers to keep the spacing to (default: the routing layer)")
+    parser.add_argument("--directions", choices=DIRECTIONS, default="manhattan", help="path directions (default: manhattan)")
+    parser.add_argument("--pitch", type=float, default=None, help="routing grid in um (default: width + spacing)")
+    parser.add_argument("--bend-cost", type=float, default=1.0, help="cost of a 90 degree bend in grid steps (default: 1)")
+    parser.add_argument("--top-cell", default=None, help="cell to route in (default: the single top cell)")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--output", required=True, help="routed layout file")
+    args = parser.parse_args(argv)
+
+    layout = pya.Layout()
+    layout.read(args.input)
+    cell = layout.cell(args.top_cell) if args.top_cell else layout.top_cell()
+    if cell is None:
+        parser.error(f"cell '{args.top_cell}' not found")
+    route_layer = layer_info(args.layer)
+    nets = read_nets(args.nets)
+
+    t_start = time.perf_counter()
+    routes = route_nets(layout, cell, route_layer.layer, nets, args.width, args.spacing, route_layer.datatype,
+                        args.obstacle_layers, args.directions, args.pitch, args.bend_cost, args.processes)
+    route_time = time.perf_counter() - t_start
+    layout.write(args.output)
+
+    routed = sum(1 for route in routes if route is not None)
+    print(f"{routed} of {len(nets)} net(s) routed in {route_time:.2f} s, written to {args.output}")
+    return 0 if routed == len(nets) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
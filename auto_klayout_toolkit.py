@@ -1,3 +1,17 @@
+import contextlib
+import datetime
+import json
+import os
+import time
+
+import pya
+
+try:
+    import psutil # optional, for memory measurement on all platforms
+except ImportError:
+    psutil = None
+
+
 def find_or_create_layer(layout, layer_info):
     """
     尝试查找指定的图层，如果不存在则创建它。
@@ -7,8 +21,331 @@ def find_or_create_layer(layout, layer_info):
     """
     layer_index = layout.find_layer(layer_info)
     if layer_index is None:
-        print(f"Layer {layer_info} is created.")
+        log(f"Layer {layer_info} is created.")
         layer_index = layout.insert_layer(layer_info)
     else:
-        print(f"Layer {layer_info} already exists.")
-    return layer_index
\ No newline at end of file
+        log(f"Layer {layer_info} already exists.")
+    return layer_index
+
+
+# -----------------------------------------------------------------------------
+# Instrumentation: named spans with timing, polygon counts and memory delta, 
+# reported to pluggable sinks instead of bare print statements.
+
+def current_rss_mb():
+    """
+    Resident memory of the current process in MB, or None if unknown.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024**2
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Span:
+    """
+    One measured stage, e.g. "boolean" in create_patch.
+    Set `inputs`/`outputs` (polygon counts) inside the `with` block.
+    """
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.inputs = None
+        self.outputs = None
+        self.seconds = None
+        self.memory_delta_mb = None
+
+    def to_dict(self):
+        return {"type": "span",
+                "name": self.name,
+                "seconds": self.seconds,
+                "inputs": self.inputs,
+                "outputs": self.outputs,
+                "memory_delta_mb": self.memory_delta_mb,
+                "attributes": self.attributes}
+
+    def __str__(self):
+        text = f"[{self.name}] {self.seconds:.3f} s"
+        if self.inputs is not None:
+            text += f", in {self.inputs}"
+        if self.outputs is not None:
+            text += f", out {self.outputs}"
+        if self.memory_delta_mb is not None:
+            text += f", {self.memory_delta_mb:+.1f} MB"
+        return text
+
+
+class PrintSink:
+    """
+    Prints messages and spans to the console (the default sink).
+    """
+    def message(self, text):
+        print(text)
+
+    def span(self, span):
+        print("  " + str(span))
+
+
+class LogFileSink:
+    """
+    Appends messages and spans as plain text lines with a timestamp to a log file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, text):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(f"{datetime.datetime.now().isoformat(timespec='milliseconds')} {text}\n")
+
+    def message(self, text):
+        self._write(text)
+
+    def span(self, span):
+        self._write(str(span))
+
+
+class JsonLinesSink:
+    """
+    Appends messages and spans as JSON lines, for machine-readable traces.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, record):
+        record["time"] = datetime.datetime.now().isoformat(timespec="milliseconds")
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record) + "\n")
+
+    def message(self, text):
+        self._write({"type": "message", "text": text})
+
+    def span(self, span):
+        self._write(span.to_dict())
+
+
+class SummarySink:
+    """
+    Collects spans in memory, e.g. to show a summary in a dialog after a run.
+    """
+    def __init__(self):
+        self.spans = []
+
+    def message(self, text):
+        pass
+
+    def span(self, span):
+        self.spans.append(span)
+
+    def text(self):
+        total = sum(span.seconds for span in self.spans)
+        lines = [str(span) for span in self.spans]
+        lines.append(f"total: {total:.3f} s")
+        return "\n".join(lines)
+
+
+class Tracer:
+    """
+    Sends messages and spans to a list of sinks.
+    """
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks) if sinks is not None else [PrintSink()]
+
+    def log(self, text):
+        for sink in self.sinks:
+            sink.message(text)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, attributes)
+        rss_start = current_rss_mb()
+        t_start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - t_start
+            rss_end = current_rss_mb()
+            if rss_start is not None and rss_end is not None:
+                span.memory_delta_mb = rss_end - rss_start
+            for sink in self.sinks:
+                sink.span(span)
+
+
+# the tracer used by all toolkit functions
+tracer = Tracer()
+
+
+def log(text):
+    """
+    Send a message to all sinks (printed to the console by default).
+    """
+    tracer.log(text)
+
+
+def span(name, **attributes):
+    """
+    Measure a stage: with span("boolean", function="create_patch") as s: ...; s.outputs = n
+    """
+    return tracer.span(name, **attributes)
+
+
+@contextlib.contextmanager
+def extra_sink(sink):
+    """
+    Add a sink for the duration of a `with` block.
+    """
+    tracer.sinks.append(sink)
+    try:
+        yield sink
+    finally:
+        tracer.sinks.remove(sink)
+
+
+# -----------------------------------------------------------------------------
+# Layout session: layers resolved once and layer geometry loaded once, shared by
+# chained toolkit calls such as grid, patch and verify.
+
+def layer_info(layer, datatype=0):
+    """
+    pya.LayerInfo from a layer number (with `datatype`), a (layer, datatype) tuple,
+    a string like "6", "6/2" or "M1 (6/2)", or a pya.LayerInfo.
+    """
+    if isinstance(layer, pya.LayerInfo):
+        return layer
+    if isinstance(layer, str):
+        return pya.LayerInfo.from_string(layer.strip())
+    if isinstance(layer, (tuple, list)):
+        return pya.LayerInfo(*layer)
+    return pya.LayerInfo(layer, datatype)
+
+
+def layer_load_options(layers):
+    """
+    Load options which read only the given layers (anything `layer_info` takes), all other
+    layers are skipped by the reader.
+    """
+    layer_map = pya.LayerMap()
+    for index, layer in enumerate(layers):
+        layer_map.map(layer_info(layer), index)
+    options = pya.LoadLayoutOptions()
+    options.set_layer_map(layer_map, False) # False: don't create the other layers
+    return options
+
+
+class LayoutSession:
+    """
+    One layout and its layers and geometry, shared by several toolkit calls.
+    Layers are looked up (or created) once. The Region of a layer of a cell is built on
+    first use and kept, as well as its merged version: the merge is often the most
+    expensive part of a boolean, and merged inputs are not merged again.
+    Shapes inserted with `insert` update the memoized Regions. The session does not track
+    other edits: it only notices a changed shape count or bounding box of the layer (and
+    instance count for hierarchical Regions), so after editing the layout outside the
+    session, e.g. by the user or by toolkit calls without `session`, call `invalidate`.
+    The Regions are shared: don't modify them, work on copies (`dup()`) instead.
+    """
+    def __init__(self, layout, cell=None, threads=None):
+        self.layout = layout
+        self.cell = cell if cell is not None else layout.top_cell()
+        self.layer_indexes = {}
+        # (cell index, layer index, hierarchical) -> [signature, raw Region, merged Region or None]
+        self.regions = {}
+        # deep-mode Regions of all hierarchical lookups share one store
+        self.deep_shape_store = pya.DeepShapeStore()
+        self.deep_shape_store.threads = threads if threads is not None else (os.cpu_count() or 1)
+
+    @classmethod
+    def from_view(cls, view=None, threads=None):
+        """
+        Session on the active cell of `view` (default: the current view of the main window).
+        """
+        if view is None:
+            view = pya.Application.instance().main_window().current_view()
+        if view is None:
+            raise Exception("No layout view open.")
+        cellview = view.active_cellview()
+        return cls(cellview.layout(), cellview.cell, threads)
+
+    def layer(self, layer, datatype=0):
+        """
+        Index of a layer (anything `layer_info` takes), created if it doesn't exist.
+        """
+        info = layer_info(layer, datatype)
+        key = str(info)
+        layer_index = self.layer_indexes.get(key)
+        if layer_index is None:
+            layer_index = self.layer_indexes[key] = find_or_create_layer(self.layout, info)
+        return layer_index
+
+    def signature(self, cell, layer_index, hierarchical):
+        """
+        Cheap check for a changed layer: shape count and bounding box, with `hierarchical`
+        summed over the cell tree together with the instance counts.
+        """
+        shape_count = cell.shapes(layer_index).size()
+        instance_count = 0
+        if hierarchical:
+            for cell_index in [cell.cell_index()] + cell.called_cells():
+                tree_cell = self.layout.cell(cell_index)
+                instance_count += tree_cell.child_instances()
+                if cell_index != cell.cell_index():
+                    shape_count += tree_cell.shapes(layer_index).size()
+        return shape_count, instance_count, cell.bbox_per_layer(layer_index)
+
+    def entry(self, layer_index, cell, hierarchical):
+        cell = cell if cell is not None else self.cell
+        key = (cell.cell_index(), layer_index, hierarchical)
+        signature = self.signature(cell, layer_index, hierarchical)
+        entry = self.regions.get(key)
+        if entry is None or entry[0] != signature:
+            if hierarchical:
+                region = pya.Region(cell.begin_shapes_rec(layer_index), self.deep_shape_store)
+            else:
+                region = pya.Region(cell.shapes(layer_index))
+            region.merged_semantics = False
+            entry = self.regions[key] = [signature, region, None]
+        return entry
+
+    def region(self, layer, cell=None, hierarchical=False, merged=True):
+        """
+        Region of the shapes of `layer` (a layer index) in `cell` (default: the session
+        cell), with `hierarchical=True` of the whole cell tree in deep mode.
+        With `merged=False` the individual shapes, with merged semantics switched off.
+        """
+        entry = self.entry(layer, cell, hierarchical)
+        if not merged:
+            return entry[1]
+        if entry[2] is None:
+            with span("merge", function="LayoutSession.region") as s:
+                entry[2] = entry[1].merged()
+                s.inputs = entry[1].count()
+                s.outputs = entry[2].count()
+        return entry[2]
+
+    def insert(self, layer, region, cell=None):
+        """
+        Insert a Region into `layer` (a layer index) of `cell`. Deep-mode Regions keep their
+        hierarchy. If the layer was empty, the Region is kept as the layer's geometry, so
+        the next call doesn't load it back from the layout.
+        """
+        cell = cell if cell is not None else self.cell
+        was_empty = cell.shapes(layer).is_empty()
+        if region.is_deep():
+            region.insert_into(self.layout, cell.cell_index(), layer)
+            return
+        cell.shapes(layer).insert(region)
+        if was_empty:
+            raw = region.dup()
+            raw.merged_semantics = False
+            merged = region.dup() if region.is_merged() else None
+            self.regions[(cell.cell_index(), layer, False)] = [self.signature(cell, layer, False), raw, merged]
+
+    def invalidate(self, layer=None, cell=None):
+        """
+        Drop the memoized Regions of `layer` (a layer index) and/or `cell`, default: all.
+        """
+        for key in list(self.regions):
+            if (layer is None or key[1] == layer) and (cell is None or key[0] == cell.cell_index()):
+                del self.regions[key]